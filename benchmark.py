@@ -0,0 +1,732 @@
+#performance benchmarks, run with: python benchmark.py <name> [--scale N]
+#each benchmark builds its own throwaway database so instance/slimeapp.db is never touched
+#python benchmark.py suite --output baseline.json records a baseline, add --compare old.json to check for regressions
+import argparse
+import json
+import os
+import logging
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import io
+import threading
+import time
+import tracemalloc
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.cookiejar import CookieJar
+from random import Random
+from datetime import timedelta
+from os import path
+from flask import Flask
+from sqlalchemy import event, insert, text, update
+from models import *
+from library import Cart, CartProduct, Catalog, SalesReport, OrderWriter, JobQueue, OutOfStock, LoginThrottle, Pager, Validation, OrderDetails, Exporter, ProductImporter
+
+
+#creates a standalone app bound to a temporary sqlite database
+def makeapp(folder):
+    benchapp = Flask(__name__)
+    benchapp.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + path.join(folder, "bench.db")
+    db.init_app(benchapp)
+    return benchapp
+
+#a job queue for benchmarks that place orders or record logins, run by a thread in this process
+def makejobs(benchapp):
+    return JobQueue(benchapp, 5, 5, 300, 1, 7, True, 10)
+
+#fills the database with a reproducible dataset, scale 1 is roughly 100k orders
+#scale 10 gives 10k products, 100k customers and 1M orders with as many login events
+def seed(scale, seednumber=1):
+    rand = Random(seednumber)
+    products = 1000 * scale
+    customers = 10000 * scale
+    orders = 100000 * scale
+    admins = 5
+    now = datetime.now()
+
+    db.session.execute(insert(dbProduct), [
+        {"name": "Slime " + str(i), "description": "seeded slime", "image": "/static/uploads/amber.webp",
+         "colour": "Amber", "price": round(rand.uniform(1, 30), 2), "stock": rand.randint(0, 100)}
+        for i in range(products)])
+    db.session.execute(insert(dbCustomer), [
+        {"forename": "test", "surname": "test", "email": "customer" + str(i) + "@gmail.com",
+         "street": "25 test road", "city": "test town", "postcode": "cv4 7al"}
+        for i in range(customers)])
+    db.session.execute(insert(dbAdmin), [
+        {"forename": "admin", "email": "admin" + str(i) + "@gmail.com", "password": b"x"} for i in range(admins)])
+
+    #orders and items are written in chunks to keep memory flat
+    chunk = 20000
+    for start in range(0, orders, chunk):
+        db.session.execute(insert(dbOrder), [
+            {"ref_number": "SC-" + str(i).zfill(16), "total_price": 10.0, "order_date": now - timedelta(minutes=orders - i),
+             "shipping_date": now - timedelta(minutes=orders - i),
+             "status": "paid", "customer_id": rand.randint(1, customers)}
+            for i in range(start, min(start + chunk, orders))])
+        items = []
+        for orderid in range(start + 1, min(start + chunk, orders) + 1):
+            for _ in range(rand.randint(1, 3)):
+                items.append({"order_id": orderid, "product_id": rand.randint(1, products),
+                              "quantity": rand.randint(1, 5), "price": 10.0})
+        db.session.execute(insert(dbOrder_Item), items)
+
+    db.session.execute(insert(dbLogin_Event), [
+        {"timestamp": now - timedelta(minutes=i), "attempts": 1, "ip_address": "10.0." + str(i % 250) + "." + str(i % 7),
+         "action_details": "Unsuccesful Login Attempt", "severity": "High", "admin_id": rand.randint(1, admins)}
+        for i in range(orders)])
+    db.session.commit()
+    return {"products": products, "customers": customers, "orders": orders}
+
+#runs a function repeatedly and returns the average time in milliseconds
+def timeit(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat * 1000
+
+def printresults(title, results):
+    print(title)
+    for name, value in results:
+        print("  {:<45} {}".format(name, value))
+
+#nearest rank percentiles of a list of seconds, in milliseconds
+def percentiles(times):
+    times = sorted(times)
+    return {"p" + str(rank): times[min(len(times) - 1, len(times) * rank // 100)] * 1000 for rank in [50, 95, 99]}
+
+
+#compares hot lookups on the pre-index schema with the migrated schema
+def bench_indexes(args):
+    lookups = [
+        ("unused ref_number check", lambda: dbOrder.query.filter_by(ref_number="SC-9999999999999999").first()),
+        ("product by name", lambda: dbProduct.query.filter_by(name="Slime 999").first()),
+        ("items by order_id", lambda: dbOrder_Item.query.filter_by(order_id=4242).all()),
+        ("orders by customer_id", lambda: dbOrder.query.filter_by(customer_id=77).all()),
+        ("login events by admin and new ip", lambda: dbLogin_Event.query.filter_by(admin_id=1, ip_address="10.1.1.1").first()),
+        ("low stock products", lambda: dbProduct.query.filter(dbProduct.stock <= 10).all()),
+    ]
+    with tempfile.TemporaryDirectory() as folder:
+        with makeapp(folder).app_context():
+            db.create_all()
+            #recreate the old schema by dropping every declared index
+            for table in db.metadata.sorted_tables:
+                for index in table.indexes:
+                    db.session.execute(text("DROP INDEX IF EXISTS " + index.name))
+            db.session.commit()
+            print("seeded", seed(args.scale))
+
+            before = [timeit(function, args.repeat) for _, function in lookups]
+            start = time.perf_counter()
+            migrate()
+            migration = (time.perf_counter() - start) * 1000
+            after = [timeit(function, args.repeat) for _, function in lookups]
+
+            printresults("lookup (ms)                                    before -> after", [
+                (name, "{:8.3f} -> {:8.3f}".format(b, a)) for (name, _), b, a in zip(lookups, before, after)])
+            print("migration took {:.0f}ms, orders kept: {}".format(migration, dbOrder.query.count()))
+
+
+#the list based cart from before carts were indexed by product id, kept for comparison
+class ListCart():
+    def __init__(self):
+        self.cartproducts = []
+
+    def gettotalprice(self):
+        return sum(product.total for product in self.cartproducts)
+
+    def addproduct(self, product):
+        for item in self.cartproducts:
+            if item.name == product.name:
+                item.increasequantity(product.quantity)
+                return
+        self.cartproducts.append(product)
+
+    def updatequantity(self, name, quantity):
+        for item in self.cartproducts:
+            if item.name == name:
+                item.updatequantity(quantity)
+
+    def removeproduct(self, name):
+        for item in self.cartproducts:
+            if item.name == name:
+                self.cartproducts.remove(item)
+                break
+
+#times add/update/remove/total on carts with thousands of lines
+def bench_cart(args):
+    lines = 5000 * args.scale
+    results = []
+    for label, cart, key in [("list by name", ListCart(), lambda i: "Slime " + str(i)),
+                             ("dict by id", Cart(), lambda i: i)]:
+        for i in range(lines):
+            cart.addproduct(CartProduct("Slime " + str(i), 1, 1.5, i))
+        last = lines - 1
+        results.append((label + ": add existing line", timeit(lambda: cart.addproduct(CartProduct("Slime " + str(last), 1, 1.5, last)), args.repeat)))
+        results.append((label + ": update quantity", timeit(lambda: cart.updatequantity(key(last), 2), args.repeat)))
+        results.append((label + ": total price", timeit(cart.gettotalprice, args.repeat)))
+        results.append((label + ": remove and re-add", timeit(lambda: (cart.removeproduct(key(last)), cart.addproduct(CartProduct("Slime " + str(last), 1, 1.5, last))), args.repeat)))
+    printresults("cart with {} lines (ms per operation)".format(lines), [(name, "{:8.4f}".format(value)) for name, value in results])
+
+
+#many threads checking out the same low stock product through the order pipeline
+def bench_checkout(args):
+    threads = 16
+    attempts = 25 * args.scale
+    stock = threads * attempts // 4
+    with tempfile.TemporaryDirectory() as folder:
+        benchapp = makeapp(folder)
+        with benchapp.app_context():
+            migrate()
+            product = dbProduct(name="Last Slime", description="seeded slime", image="/static/uploads/amber.webp",
+                                colour="Amber", price=5.0, stock=stock)
+            db.session.add(product)
+            db.session.commit()
+            productid = product.id
+
+        writer = OrderWriter(SalesReport(), Catalog(2), makejobs(benchapp), 10)
+        placed = []
+        rejected = []
+        failed = []
+        def shopper(number):
+            with benchapp.app_context():
+                for attempt in range(attempts):
+                    cart = Cart()
+                    cart.addproduct(CartProduct("Last Slime", 1, 5.0, productid))
+                    details = {"forename": "test", "surname": "test", "email": "buyer" + str(number) + "@gmail.com",
+                               "street": "25 test road", "city": "test town", "postcode": "cv4 7al"}
+                    try:
+                        writer.placeorder(details, cart)
+                        placed.append(number)
+                    except OutOfStock:
+                        rejected.append(number)
+                    except Exception as error:
+                        failed.append(error)
+
+        start = time.perf_counter()
+        workers = [threading.Thread(target=shopper, args=(number,)) for number in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+
+        with benchapp.app_context():
+            finalstock = db.session.get(dbProduct, productid).stock
+            orders = dbOrder.query.count()
+        printresults("{} threads x {} checkouts of one product with stock {}".format(threads, attempts, stock), [
+            ("checkouts per second", "{:.0f}".format((len(placed) + len(rejected)) / elapsed)),
+            ("orders placed", len(placed)),
+            ("rejected for stock", len(rejected)),
+            ("errors", len(failed)),
+            ("final stock", finalstock),
+            ("oversold", max(0, orders - stock) + max(0, -finalstock)),
+        ])
+
+
+#the reference number loop from before RefNumbers, kept for comparison
+def oldrefnumber(rand):
+    isnew = False
+    while not isnew:
+        refnum = "SC-"
+        for i in range(16):
+            refnum += str(rand.randint(0, 9))
+            if not dbOrder.query.filter_by(ref_number=refnum).first():
+                isnew = True
+    return refnum
+
+#order creation rate with a large order history (scale 10 is 1M orders)
+def bench_refnumbers(args):
+    existing = 100000 * args.scale
+    created = 200
+    rand = Random(1)
+    now = datetime.now()
+    with tempfile.TemporaryDirectory() as folder:
+        benchapp = makeapp(folder)
+        with benchapp.app_context():
+            migrate()
+            product = dbProduct(name="Slime", description="seeded slime", image="/static/uploads/amber.webp",
+                                colour="Amber", price=5.0, stock=created * 10)
+            db.session.add(product)
+            db.session.add(dbCustomer(forename="test", surname="test", email="test@gmail.com",
+                                      street="25 test road", city="test town", postcode="cv4 7al"))
+            db.session.commit()
+            for start in range(0, existing, 50000):
+                db.session.execute(insert(dbOrder), [
+                    {"ref_number": "SC-" + str(rand.randrange(10 ** 16)).zfill(16) + "-" + str(i), "total_price": 10.0,
+                     "order_date": now, "shipping_date": now, "status": "paid", "customer_id": 1}
+                    for i in range(start, min(start + 50000, existing))])
+            db.session.commit()
+
+            details = {"forename": "test", "surname": "test", "email": "test@gmail.com",
+                       "street": "25 test road", "city": "test town", "postcode": "cv4 7al"}
+            writer = OrderWriter(SalesReport(), Catalog(2), makejobs(benchapp), 10)
+            cart = Cart()
+            cart.addproduct(CartProduct("Slime", 1, 5.0, product.id))
+            results = [
+                ("old loop, reference number only", timeit(lambda: oldrefnumber(rand), created)),
+                ("RefNumbers, reference number only", timeit(writer.refnumbers.generate, created)),
+                ("full order through OrderWriter", timeit(lambda: writer.placeorder(details, cart), created)),
+            ]
+            printresults("{} existing orders (ms per order)".format(dbOrder.query.count() - created), [
+                (name, "{:8.3f} ({:.0f} per second)".format(value, 1000 / value)) for name, value in results])
+
+
+#the login event scan from before LoginThrottle, kept for comparison
+def oldloginevent(adminid, ip_address):
+    timestamp = datetime.now()
+    for loginevent in dbLogin_Event.query.filter_by(admin_id=adminid).all():
+        if loginevent.ip_address == ip_address:
+            if (timestamp <= loginevent.timestamp + timedelta(minutes=10)) and (timestamp >= loginevent.timestamp):
+                return loginevent
+
+#throttle checks against a large login event table (scale 1 is 100k events)
+def bench_login(args):
+    with tempfile.TemporaryDirectory() as folder:
+        benchapp = makeapp(folder)
+        with benchapp.app_context():
+            migrate()
+            print("seeded", seed(args.scale))
+            jobs = makejobs(benchapp)
+            throttle = LoginThrottle(benchapp, jobs, 600, 10000, 5)
+            results = [
+                ("old scan, known ip", timeit(lambda: oldloginevent(1, "10.0.3.3"), args.repeat)),
+                ("old scan, new ip", timeit(lambda: oldloginevent(1, "10.1.1.1"), args.repeat)),
+                ("throttle, first check for a new ip", timeit(lambda: LoginThrottle(benchapp, jobs, 600, 10, 5).attempts(1, "10.1.1.1"), args.repeat)),
+            ]
+            throttle.record(1, "10.1.1.1", "Unsuccesful Login Attempt", "High")
+            results.append(("throttle, repeat check below the limit (reads the saved row)", timeit(lambda: throttle.attempts(1, "10.1.1.1"), args.repeat)))
+            results.append(("throttle, record failed attempt (upserts and commits the row)", timeit(lambda: throttle.record(1, "10.1.1.1", "Unsuccesful Login Attempt", "High"), args.repeat)))
+            throttle.flush()
+            printresults("{} login events (ms per call)".format(dbLogin_Event.query.count()), [
+                (name, "{:8.4f}".format(value)) for name, value in results])
+
+
+#deep pages of the admin order list, the old page loaded every order at once
+def bench_pages(args):
+    with tempfile.TemporaryDirectory() as folder:
+        with makeapp(folder).app_context():
+            migrate()
+            print("seeded", seed(args.scale))
+            pager = Pager(50, 30)
+            query, column = Validation().sorter(dbOrder.order_date, "desc", dbOrder, "")
+            deep = query.offset(dbOrder.query.count() - 100).first().id
+            results = [
+                ("old page, every order", timeit(lambda: dbOrder.query.all(), 3)),
+                ("offset, last page", timeit(lambda: query.offset(dbOrder.query.count() - 50).limit(51).all(), args.repeat)),
+                ("keyset, first page", timeit(lambda: pager.page(query, dbOrder, dbOrder.order_date, "desc", None, "bench"), args.repeat)),
+                ("keyset, last page", timeit(lambda: pager.page(query, dbOrder, dbOrder.order_date, "desc", deep, "bench"), args.repeat)),
+            ]
+            printresults("{} orders, 50 per page (ms per page)".format(dbOrder.query.count()), [
+                (name, "{:8.3f}".format(value)) for name, value in results])
+
+
+#admin searches on a large order table, the old filter was a LIKE scan of one column
+def bench_search(args):
+    with tempfile.TemporaryDirectory() as folder:
+        with makeapp(folder).app_context():
+            migrate()
+            print("seeded", seed(args.scale))
+            pager = Pager(50, 0)
+            search = Validation()
+            def searchpage(searchitem, column):
+                query, column = search.sorter(column, "asc", dbOrder, searchitem)
+                return pager.page(query, dbOrder, column, "asc", None, searchitem)
+            results = [
+                ("old LIKE on ref_number", timeit(lambda: dbOrder.query.filter(dbOrder.ref_number.contains("0004242")).order_by(dbOrder.ref_number).all(), args.repeat)),
+                ("fts ref_number, ranked page", timeit(lambda: searchpage("0004242", None), args.repeat)),
+                ("fts customer email, ranked page", timeit(lambda: searchpage("customer4242@", None), args.repeat)),
+                ("fts status, page sorted by date", timeit(lambda: searchpage("paid", dbOrder.order_date), args.repeat)),
+            ]
+            printresults("{} orders (ms per search, count included)".format(dbOrder.query.count()), [
+                (name, "{:8.3f}".format(value)) for name, value in results])
+
+
+#the order page lookups from before OrderDetails, kept for comparison
+def oldorderdetail(refnum):
+    order = dbOrder.query.filter_by(ref_number=refnum).first()
+    customer = dbCustomer.query.filter_by(id=order.customer_id).first()
+    orderitems = dbOrder_Item.query.filter_by(order_id=order.id).all()
+    products = []
+    for item in orderitems:
+        products = dbProduct.query.filter_by(id=item.product_id).all()
+    return order, customer, orderitems, products
+
+#queries and time to load one order page as the number of items grows
+def bench_orderdetail(args):
+    sizes = [1, 10, 50, 200]
+    with tempfile.TemporaryDirectory() as folder:
+        with makeapp(folder).app_context():
+            migrate()
+            db.session.add(dbCustomer(forename="test", surname="test", email="test@gmail.com",
+                                      street="25 test road", city="test town", postcode="cv4 7al"))
+            db.session.execute(insert(dbProduct), [
+                {"name": "Slime " + str(i), "description": "seeded slime", "image": "/static/uploads/amber.webp",
+                 "colour": "Amber", "price": 5.0, "stock": 10} for i in range(max(sizes))])
+            for size in sizes:
+                order = dbOrder(ref_number="SC-" + str(size).zfill(16), total_price=10.0, order_date=datetime.now(),
+                                shipping_date=datetime.now(), status="paid", customer_id=1)
+                db.session.add(order)
+                db.session.flush()
+                db.session.execute(insert(dbOrder_Item), [
+                    {"order_id": order.id, "product_id": i + 1, "quantity": 1, "price": 5.0} for i in range(size)])
+            db.session.commit()
+
+            details = OrderDetails()
+            statements = []
+            def record(conn, cursor, statement, parameters, context, executemany):
+                statements.append(statement)
+            def measure(function):
+                db.session.expunge_all()
+                statements.clear()
+                event.listen(db.engine, "before_cursor_execute", record)
+                function()
+                event.remove(db.engine, "before_cursor_execute", record)
+                queries = len(statements)
+                return "{:4d} queries {:8.3f}ms".format(queries, timeit(lambda: (db.session.expunge_all(), function()), args.repeat))
+            results = []
+            for size in sizes:
+                refnum = "SC-" + str(size).zfill(16)
+                results.append(("{} items, old lookups".format(size), measure(lambda: oldorderdetail(refnum))))
+                results.append(("{} items, OrderDetails".format(size), measure(lambda: details.byref(refnum))))
+            printresults("order page loads", results)
+
+
+#exports every order item, measuring time to the first chunk, total time and peak memory
+def bench_export(args):
+    with tempfile.TemporaryDirectory() as folder:
+        with makeapp(folder).app_context():
+            migrate()
+            print("seeded", seed(args.scale))
+            exporter = Exporter(SalesReport(), 1000)
+            results = []
+            for fmt in ["csv", "jsonl"]:
+                tracemalloc.start()
+                start = time.perf_counter()
+                chunks = exporter.stream("orderitems", fmt)
+                size = len(next(chunks))
+                first = (time.perf_counter() - start) * 1000
+                for chunk in chunks:
+                    size += len(chunk)
+                total = (time.perf_counter() - start) * 1000
+                peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+                tracemalloc.stop()
+                results.append((fmt + " streamed", "first chunk {:6.1f}ms, all {:7.0f}ms, {:5.1f}MB out, peak {:5.1f}MB".format(first, total, size / 1024 / 1024, peak)))
+            tracemalloc.start()
+            start = time.perf_counter()
+            rows = dbOrder_Item.query.all()
+            total = (time.perf_counter() - start) * 1000
+            peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+            tracemalloc.stop()
+            results.append(("query.all() for comparison", "{} rows in {:7.0f}ms, peak {:5.1f}MB".format(len(rows), total, peak)))
+            printresults("order item export", results)
+
+
+#loads a 100k product feed (scale 1) through ProductImporter, then again to update every row
+def bench_import(args):
+    rows = 100000 * args.scale
+    feed = "name,description,image,colour,price,stock\n" + "".join(
+        "Feed Slime {},seeded slime,/static/uploads/amber.webp,Amber,{:.2f},{}\n".format(i, 1 + i % 30, i % 100) for i in range(rows))
+    with tempfile.TemporaryDirectory() as folder:
+        with makeapp(folder).app_context():
+            migrate()
+            catalog = Catalog(2)
+            #the old way, one form post and commit per product
+            start = time.perf_counter()
+            for i in range(1000):
+                db.session.add(dbProduct(name="Form Slime " + str(i), description="seeded slime", image="/static/uploads/amber.webp",
+                                         colour="Amber", price=1.0, stock=1))
+                db.session.commit()
+            perproduct = (time.perf_counter() - start) / 1000
+            importer = ProductImporter(catalog, 2000)
+            results = [("commit per product, estimated for the feed", "{:8.1f}s".format(perproduct * rows))]
+            for label in ["import new products", "import again, updating by name"]:
+                start = time.perf_counter()
+                report = importer.load(io.StringIO(feed), "csv")
+                results.append((label, "{:8.1f}s ({} added, {} updated, {} failed)".format(
+                    time.perf_counter() - start, report.inserted, report.updated, report.failed)))
+            printresults("{} product feed".format(rows), results)
+
+
+#one side of the load benchmark, run in its own process because main reads the database settings on import
+def bench_loadrun(args):
+    from main import app as shopapp
+    with shopapp.app_context():
+        migrate()
+        db.session.execute(insert(dbProduct), [
+            {"name": "Slime " + str(i), "description": "seeded slime", "image": "/static/uploads/amber.webp",
+             "colour": "Amber", "price": 5.0, "stock": 1000000} for i in range(200)])
+        db.session.commit()
+    checkout = {"forename": "test", "surname": "test", "email": "test@gmail.com", "street": "25 test road",
+                "city": "test town", "postcode": "cv4 7al", "cardnumber": "1234567890", "expirydate": "2099-04", "cvv": "123"}
+    latencies = {"storefront": [], "checkout": []}
+    errors = []
+    end = time.perf_counter() + 5 * args.scale
+    def visitor(number):
+        client = shopapp.test_client()
+        rand = Random(number)
+        while time.perf_counter() < end:
+            start = time.perf_counter()
+            #roughly one visit in five adds to the cart and checks out, the rest browse
+            if rand.random() < 0.2:
+                kind = "checkout"
+                client.post("/home/product/{}/addedtocart".format(rand.randint(1, 200)), data={"quantity": 1})
+                response = client.post("/cart/checkout/complete", data=checkout)
+            else:
+                kind = "storefront"
+                response = client.get(rand.choice(["/home", "/home/product/{}".format(rand.randint(1, 200))]))
+            if response.status_code >= 400 and response.status_code != 404:
+                errors.append(response.status_code)
+            latencies[kind].append(time.perf_counter() - start)
+    workers = [threading.Thread(target=visitor, args=(number,)) for number in range(8)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    results = {"errors": len(errors)}
+    for kind, times in latencies.items():
+        times.sort()
+        results[kind] = {"per second": len(times) / (5 * args.scale), "p50": times[len(times) // 2] * 1000,
+                         "p95": times[int(len(times) * 0.95)] * 1000}
+    print(json.dumps(results))
+
+#8 threads browsing and checking out against sqlite's defaults and then the tuned settings
+def bench_load(args):
+    rows = []
+    for label, tuning in [("sqlite defaults", "0"), ("WAL and pragmas", "1")]:
+        with tempfile.TemporaryDirectory() as folder:
+            env = dict(os.environ, DATABASE_URL="sqlite:///" + path.join(folder, "load.db"), SQLITE_TUNING=tuning)
+            output = subprocess.run([sys.executable, __file__, "loadrun", "--scale", str(args.scale)], env=env,
+                                    capture_output=True, text=True, check=True).stdout
+        results = json.loads(output.strip().splitlines()[-1])
+        for kind in ["storefront", "checkout"]:
+            rows.append(("{}, {}".format(label, kind), "{:7.1f}/s  p50 {:6.1f}ms  p95 {:6.1f}ms".format(
+                results[kind]["per second"], results[kind]["p50"], results[kind]["p95"])))
+        rows.append(("{}, errors".format(label), results["errors"]))
+    printresults("mixed storefront and checkout load", rows)
+
+
+#the suite's requests, a visitor sends a scenario's steps in order and only named steps are timed
+suitecheckout = {"forename": "test", "surname": "test", "email": "suite@gmail.com", "street": "25 test road",
+                 "city": "test town", "postcode": "cv4 7al", "cardnumber": "1234567890", "expirydate": "2099-04", "cvv": "123"}
+suitescenarios = [
+    ("home", 30, lambda rand, data: [("home", "GET", "/home", None)]),
+    ("product", 30, lambda rand, data: [("product", "GET", "/home/product/{}".format(rand.randint(1, data["products"])), None)]),
+    ("cart", 10, lambda rand, data: [
+        ("addtocart", "POST", "/home/product/{}/addedtocart".format(rand.choice(data["stocked"])), {"quantity": 1}),
+        ("cart", "GET", "/cart", None)]),
+    ("checkout", 5, lambda rand, data: [
+        (None, "POST", "/home/product/{}/addedtocart".format(rand.choice(data["stocked"])), {"quantity": 1}),
+        ("checkout", "POST", "/cart/checkout/complete", suitecheckout)]),
+    ("tracking", 10, lambda rand, data: [("tracking", "POST", "/trackorder/view", dict(zip(["refnum", "email"], rand.choice(data["orders"]))))]),
+    ("admin", 5, lambda rand, data: [
+        ("adminhome", "GET", "/admin", None),
+        ("adminorders", "GET", "/admin/orders", None),
+        ("adminproducts", "GET", "/admin/products", None)]),
+]
+
+#collects latency and the query count from the Server-Timing header for each timed step
+class SuiteVisitor():
+    def __init__(self, results):
+        self.results = results
+
+    def send(self, name, method, url, data):
+        start = time.perf_counter()
+        status, timing = self.request(method, url, data)
+        elapsed = time.perf_counter() - start
+        if name is None:
+            return
+        found = re.search(r'desc="(\d+) queries"', timing or "")
+        result = self.results.setdefault(name, {"times": [], "queries": [], "errors": 0})
+        result["times"].append(elapsed)
+        result["queries"].append(int(found.group(1)) if found else 0)
+        if status >= 400:
+            result["errors"] += 1
+
+class TestClientVisitor(SuiteVisitor):
+    def __init__(self, results, shopapp):
+        super().__init__(results)
+        self.client = shopapp.test_client()
+
+    def request(self, method, url, data):
+        response = self.client.open(url, method=method, data=data)
+        response.get_data()
+        response.close()
+        return response.status_code, response.headers.get("Server-Timing")
+
+#a real http client with its own cookies, redirects are timed as their own response rather than followed
+class HttpVisitor(SuiteVisitor):
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args):
+            return None
+
+    def __init__(self, results, baseurl):
+        super().__init__(results)
+        self.baseurl = baseurl
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()), self.NoRedirect())
+
+    def request(self, method, url, data):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        try:
+            with self.opener.open(urllib.request.Request(self.baseurl + url, data=body, method=method)) as response:
+                response.read()
+                return response.status, response.headers.get("Server-Timing")
+        except urllib.error.HTTPError as error:
+            error.read()
+            return error.code, error.headers.get("Server-Timing")
+
+def summarise(results, seconds=None):
+    summary = {}
+    for name, result in sorted(results.items()):
+        summary[name] = {"requests": len(result["times"]), "errors": result["errors"],
+                         "queries": sum(result["queries"]) / len(result["queries"]), "max queries": max(result["queries"])}
+        summary[name].update(percentiles(result["times"]))
+        if seconds:
+            summary[name]["per second"] = len(result["times"]) / seconds
+    return summary
+
+#the suite's worker, run in its own process because main reads the database settings on import
+def bench_suiterun(args):
+    import bcrypt
+    from werkzeug.serving import make_server
+    from main import app as shopapp
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    with shopapp.app_context():
+        migrate()
+        seeded = seed(args.scale, args.seed)
+        #a cheap hash keeps the suite timing pages rather than bcrypt
+        db.session.add(dbAdmin(forename="bench", email="bench@gmail.com", password=bcrypt.hashpw(b"benchpass", bcrypt.gensalt(4))))
+        db.session.execute(update(dbProduct).where(dbProduct.id <= 50).values(stock=1000000))
+        db.session.commit()
+        orders = db.session.query(dbOrder.ref_number, dbCustomer.email).join(dbCustomer, dbOrder.customer_id == dbCustomer.id)
+        data = {"products": seeded["products"], "stocked": list(range(1, 51)),
+                "orders": [tuple(row) for row in orders.filter(dbOrder.id % (seeded["orders"] // 200) == 0).limit(200)]}
+        db.session.remove()
+    login = {"email": "bench@gmail.com", "password": "benchpass"}
+
+    #every scenario in turn through the test client, one visitor so the numbers are free of contention
+    results = {}
+    visitor = TestClientVisitor(results, shopapp)
+    visitor.send(None, "POST", "/admin/login", login)
+    rand = Random(args.seed)
+    for _ in range(args.repeat):
+        for _, _, steps in suitescenarios:
+            for step in steps(rand, data):
+                visitor.send(*step)
+    report = {"seeded": seeded, "testclient": summarise(results)}
+
+    #threads picking weighted scenarios against a real threaded http server
+    server = make_server("127.0.0.1", 0, shopapp, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    results = {}
+    lock = threading.Lock()
+    end = time.perf_counter() + args.duration
+    def worker(number):
+        visitor = HttpVisitor({}, "http://127.0.0.1:{}".format(server.server_port))
+        visitor.send(None, "POST", "/admin/login", login)
+        rand = Random(args.seed * 1000 + number)
+        names = [name for name, _, _ in suitescenarios]
+        weights = [weight for _, weight, _ in suitescenarios]
+        scenarios = {name: steps for name, _, steps in suitescenarios}
+        while time.perf_counter() < end:
+            for step in scenarios[rand.choices(names, weights)[0]](rand, data):
+                visitor.send(*step)
+        with lock:
+            for name, result in visitor.results.items():
+                total = results.setdefault(name, {"times": [], "queries": [], "errors": 0})
+                total["times"] += result["times"]
+                total["queries"] += result["queries"]
+                total["errors"] += result["errors"]
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(number,)) for number in range(args.threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    report["http"] = summarise(results, elapsed)
+    report["http total per second"] = sum(len(result["times"]) for result in results.values()) / elapsed
+    print(json.dumps(report))
+
+#prints how each route's percentiles moved against an older baseline, returns true if any got worse than the tolerance
+def comparebaseline(old, new, tolerance):
+    rows = []
+    regressed = False
+    for phase in ["testclient", "http"]:
+        for name, result in new[phase].items():
+            before = old.get(phase, {}).get(name)
+            if before is None:
+                continue
+            for rank in ["p50", "p95", "p99"]:
+                change = (result[rank] - before[rank]) / before[rank] if before[rank] else 0
+                flag = ""
+                if change > tolerance:
+                    flag = "  REGRESSION"
+                    regressed = True
+                rows.append(("{} {} {}".format(phase, name, rank), "{:8.1f}ms -> {:8.1f}ms {:+7.0%}{}".format(before[rank], result[rank], change, flag)))
+            #the test client phase sends the same requests every run so any extra query is real
+            if phase == "testclient" and result["queries"] > before["queries"]:
+                rows.append(("{} {} queries".format(phase, name), "{:.1f} -> {:.1f}  REGRESSION".format(before["queries"], result["queries"])))
+                regressed = True
+    printresults("against " + old["meta"]["created"], rows)
+    return regressed
+
+#seeds a database, drives every customer and admin route through the test client and then over http,
+#and writes p50/p95/p99, throughput and queries per request to a json baseline
+def bench_suite(args):
+    with tempfile.TemporaryDirectory() as folder:
+        env = dict(os.environ, DATABASE_URL="sqlite:///" + path.join(folder, "suite.db"), METRICS_ENABLED="1")
+        command = [sys.executable, __file__, "suiterun", "--scale", str(args.scale), "--repeat", str(args.repeat),
+                   "--seed", str(args.seed), "--threads", str(args.threads), "--duration", str(args.duration)]
+        output = subprocess.run(command, env=env, capture_output=True, text=True, check=True).stdout
+    report = json.loads(output.strip().splitlines()[-1])
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=path.dirname(path.abspath(__file__)), capture_output=True, text=True).stdout.strip()
+    report["meta"] = {"created": datetime.now().isoformat(timespec="seconds"), "commit": commit, "python": platform.python_version(),
+                      "scale": args.scale, "seed": args.seed, "repeat": args.repeat, "threads": args.threads, "duration": args.duration}
+    for phase in ["testclient", "http"]:
+        printresults(phase + " (ms)", [(name, "p50 {p50:7.1f}  p95 {p95:7.1f}  p99 {p99:7.1f}  {queries:5.1f} queries  {errors} errors".format(**result))
+                                       for name, result in report[phase].items()])
+    print("http requests per second: {:.1f}".format(report["http total per second"]))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            if comparebaseline(json.load(file), report, args.tolerance):
+                sys.exit(1)
+
+
+benchmarks = {
+    "indexes": bench_indexes,
+    "cart": bench_cart,
+    "checkout": bench_checkout,
+    "refnumbers": bench_refnumbers,
+    "login": bench_login,
+    "pages": bench_pages,
+    "search": bench_search,
+    "orderdetail": bench_orderdetail,
+    "export": bench_export,
+    "import": bench_import,
+    "load": bench_load,
+    "loadrun": bench_loadrun,
+    "suite": bench_suite,
+    "suiterun": bench_suiterun,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=sorted(benchmarks))
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--duration", type=int, default=10, help="seconds of http load")
+    parser.add_argument("--output", help="write the suite's results to this json file")
+    parser.add_argument("--compare", help="a baseline json file the suite's results are checked against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="how much slower a percentile can get before it counts as a regression")
+    args = parser.parse_args()
+    benchmarks[args.benchmark](args)
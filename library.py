@@ -1,72 +1,1412 @@
 import re
-from sqlalchemy import func
+import math
+import csv
+import io
+import gzip
+import mimetypes
+import hashlib
+import json
+import secrets
+import threading
+import bcrypt
+import brotli
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from time import monotonic, perf_counter, sleep
+from os import makedirs, path, remove, replace, stat, walk
+from collections import OrderedDict, namedtuple
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from sqlalchemy import Float, Integer, and_, event, func, insert, literal, or_, select, text, tuple_, update
+from sqlalchemy.dialects.sqlite import insert as sqliteinsert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 from datetime import *
+from flask import before_render_template, current_app, g, has_request_context, request, send_file, session, template_rendered
+from werkzeug.security import safe_join
+from werkzeug.utils import secure_filename
+from PIL import Image
+from models import *
 
 
+#converts an amount to whole minor units (pence, cents, yen), rounding halves up
+def tominor(amount, rate=1, digits=2):
+    return int((Decimal(str(amount)) * rate * 10 ** digits).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
 class CartProduct:
     #Each product in the cart is a class for simple attribute access
-    def __init__(self, name, quantity, price):
+    def __init__(self, name, quantity, price, productid=None):
+        self.id = productid
         self.name = name
         self.quantity = quantity
         self.price = price
-        self.total = quantity * price
+        #totals are worked out in whole pence so they don't drift
+        self.unitpence = tominor(price)
+        self.settotal()
+
+    def settotal(self):
+        self.totalpence = self.quantity * self.unitpence
+        self.total = self.totalpence / 100
 
     #increases the quantity by a given amount
     def increasequantity(self, amount):
         self.quantity += amount
-        self.total = self.quantity * self.price
+        self.settotal()
 
     #decreases the quantity by a given amount
     def decreasequantity(self, amount):
         self.quantity -= amount
-        self.total = self.quantity * self.price
+        self.settotal()
 
     #overrides the quantity in the cart
     def updatequantity(self, quantity):
         self.quantity = quantity
-        self.total = self.quantity * self.price
+        self.settotal()
 
 class Cart():
-    #holds all the products in the user's cart
+    #holds all the products in the user's cart, indexed by product id
     def __init__(self):
-        self.cartproducts = []
+        self.cartproducts = {}
+        #running totals so reading them never walks the cart
+        self.totalpence = 0
+        self.totalquantity = 0
+
+    #applies the change in a line's quantity and total to the running totals
+    def adjusttotals(self, quantity, pence):
+        self.totalquantity += quantity
+        self.totalpence += pence
 
     #gets the total price of all products in the cart
     def gettotalprice(self): 
-        totalprice = 0
-        if len(self.cartproducts) != 0:
-            #if there are items in the cart then return total price
-            for product in self.cartproducts:
-                totalprice = totalprice + product.total
-        return totalprice
+        return self.totalpence / 100
     
     def gettotalproducts(self): 
         #gets the total number of products in the cart
         return len(self.cartproducts) 
 
+    def gettotalquantity(self):
+        #gets the number of items across all products in the cart
+        return self.totalquantity
+
     def getproducts(self): 
         #gets all products in the cart
-        return self.cartproducts
+        return list(self.cartproducts.values())
+
+    def getproduct(self, productid):
+        #gets a product in the cart, or None if it isn't in the cart
+        return self.cartproducts.get(productid)
+
+    def getquantities(self):
+        #gets product id -> quantity for the cart store
+        return {productid: product.quantity for productid, product in self.cartproducts.items()}
     
     def addproduct(self, product): 
-        #adds a product to the cart
-        self.cartproducts.append(product)
+        #adds a product to the cart, or increases the quantity if it is already there
+        existing = self.cartproducts.get(product.id)
+        if existing:
+            self.increasequantity(product.id, product.quantity)
+        else:
+            self.cartproducts[product.id] = product
+            self.adjusttotals(product.quantity, product.totalpence)
 
-    def removeproduct(self, product_name): 
+    def increasequantity(self, productid, amount):
+        #increases the quantity of a product in the cart
+        product = self.cartproducts[productid]
+        oldtotal = product.totalpence
+        product.increasequantity(amount)
+        self.adjusttotals(amount, product.totalpence - oldtotal)
+
+    def updatequantity(self, productid, quantity):
+        #overrides the quantity of a product in the cart
+        product = self.cartproducts.get(productid)
+        if product:
+            oldquantity = product.quantity
+            oldtotal = product.totalpence
+            product.updatequantity(quantity)
+            self.adjusttotals(quantity - oldquantity, product.totalpence - oldtotal)
+
+    def removeproduct(self, productid): 
         #removes a specified product from the cart
-        for product in self.cartproducts:
-            if product.name == product_name:
-                self.cartproducts.remove(product)
-                break
+        product = self.cartproducts.pop(productid, None)
+        if product:
+            self.adjusttotals(-product.quantity, -product.totalpence)
 
     def emptycart(self): 
         #removes all products from the cart
-        self.cartproducts = []
+        self.cartproducts = {}
+        self.totalpence = 0
+        self.totalquantity = 0
+
+class CartRecord:
+    #compact stored form of a cart, only product id -> quantity is kept
+    __slots__ = ("items", "touched")
+
+    def __init__(self, items, touched):
+        self.items = items
+        self.touched = touched
+
+class MemoryCartStore():
+    #keeps carts in this process, only suitable for a single worker
+    def __init__(self, maxcarts, ttl):
+        #ordered from least to most recently used
+        self.carts = OrderedDict()
+        self.maxcarts = maxcarts
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    #returns the items in a cart, or an empty dict if it doesn't exist or has expired
+    def get(self, cartid):
+        with self.lock:
+            record = self.carts.get(cartid)
+            if record is None:
+                return {}
+            now = monotonic()
+            if now - record.touched > self.ttl:
+                del self.carts[cartid]
+                return {}
+            record.touched = now
+            self.carts.move_to_end(cartid)
+            return dict(record.items)
+
+    #stores the items in a cart, an empty cart is removed
+    def save(self, cartid, items):
+        with self.lock:
+            if not items:
+                self.carts.pop(cartid, None)
+                return
+            self.carts[cartid] = CartRecord(dict(items), monotonic())
+            self.carts.move_to_end(cartid)
+            self.evict()
+
+    def delete(self, cartid):
+        with self.lock:
+            self.carts.pop(cartid, None)
+
+    #drops expired carts and the least recently used ones over the limit, caller holds the lock
+    def evict(self):
+        now = monotonic()
+        while self.carts:
+            oldest = next(iter(self.carts.values()))
+            if len(self.carts) > self.maxcarts or now - oldest.touched > self.ttl:
+                self.carts.popitem(last=False)
+            else:
+                break
+
+class DatabaseCartStore():
+    #keeps carts in the dbCart table so every worker process sees the same carts
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.saves = 0
+
+    #returns the items in a cart, or an empty dict if it doesn't exist or has expired
+    def get(self, cartid):
+        record = db.session.get(dbCart, cartid)
+        if record is None or record.updated < datetime.now() - timedelta(seconds=self.ttl):
+            return {}
+        return {int(productid): quantity for productid, quantity in json.loads(record.items).items()}
+
+    #stores the items in a cart, an empty cart is removed
+    def save(self, cartid, items):
+        if not items:
+            self.delete(cartid)
+            return
+        record = db.session.get(dbCart, cartid)
+        if record is None:
+            record = dbCart(cart_id=cartid)
+            db.session.add(record)
+        record.items = json.dumps(items)
+        record.updated = datetime.now()
+        db.session.commit()
+        #every so often clear out abandoned carts
+        self.saves += 1
+        if self.saves % 100 == 0:
+            self.evict()
+
+    def delete(self, cartid):
+        dbCart.query.filter_by(cart_id=cartid).delete()
+        db.session.commit()
+
+    #removes carts that haven't been touched within the ttl
+    def evict(self):
+        dbCart.query.filter(dbCart.updated < datetime.now() - timedelta(seconds=self.ttl)).delete()
+        db.session.commit()
+
+class SalesLine:
+    #each row of the admin sales report
+    def __init__(self, name, quantity, price, revenue):
+        self.name = name
+        self.quantity = quantity
+        self.price = price
+        #revenue is what customers actually paid, not quantity * current price
+        self.total = round(revenue, 2)
+
+#wakes the worker of each queue that added jobs, once the transaction that added them commits
+#one listener for every queue, so a queue that is thrown away isn't kept alive by it
+def jobscommitted(session):
+    for queue in session.info.pop("queuedjobs", ()):
+        queue.wake.set()
+
+event.listen(RoutingSession, "after_commit", jobscommitted)
+
+class JobQueue():
+    #deferred work kept in dbJob, so it survives a restart and can be run by other processes with flask runjobs
+    #a failed job is retried after backoff seconds, doubling each time, and left as failed with its error after maxattempts
+    def __init__(self, app, maxattempts, backoff, timeout, pollinterval, keepdays, inprocess, flushwait):
+        self.app = app
+        self.maxattempts = maxattempts
+        self.backoff = backoff
+        #a job running for longer than this is taken to belong to a worker that died, and is claimed again
+        self.timeout = timedelta(seconds=timeout)
+        self.pollinterval = pollinterval
+        self.keep = timedelta(days=keepdays)
+        #longest flush waits for jobs running in other workers, one of them may have died
+        self.flushwait = flushwait
+        #runs a worker thread in this process, turned off when flask runjobs workers do the work
+        self.inprocess = inprocess
+        self.handlers = {}
+        self.wake = threading.Event()
+        self.lock = threading.Lock()
+        self.worker = None
+        self.pruned = None
+
+    #handler is called with the job's payload inside an app context, its changes are committed with the job
+    def register(self, kind, handler):
+        self.handlers[kind] = handler
+
+    #adds a job to the current transaction, so it only runs if the work that queued it is committed
+    #a job with the key of one already queued or finished is ignored
+    def enqueue(self, kind, payload, key=None, delay=0):
+        db.session.execute(sqliteinsert(dbJob).values(
+            kind=kind, payload=json.dumps(payload), key=key, status="queued", attempts=0,
+            run_after=datetime.now() + timedelta(seconds=delay)).on_conflict_do_nothing(index_elements=["key"]))
+        db.session.info.setdefault("queuedjobs", set()).add(self)
+        if self.inprocess:
+            self.startworker()
+
+    def startworker(self):
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.work, daemon=True)
+                self.worker.start()
+
+    #claims the oldest due job, or one left running by a worker that died
+    def claim(self):
+        now = datetime.now()
+        due = select(dbJob.id).where(or_(and_(dbJob.status == "queued", dbJob.run_after <= now),
+                                         and_(dbJob.status == "running", dbJob.locked_at < now - self.timeout))) \
+            .order_by(dbJob.id).limit(1).scalar_subquery()
+        job = db.session.execute(update(dbJob).where(dbJob.id == due)
+                                 .values(status="running", locked_at=now, attempts=dbJob.attempts + 1)
+                                 .returning(dbJob.id, dbJob.kind, dbJob.payload, dbJob.attempts)
+                                 .execution_options(synchronize_session=False)).first()
+        db.session.commit()
+        return job, now
+
+    #runs one job, returns False if there was nothing to do
+    def runone(self):
+        job, claimed = self.claim()
+        if job is None:
+            return False
+        try:
+            self.handlers[job.kind](json.loads(job.payload))
+            #marked done in the handler's transaction so its changes are applied once,
+            #unless the job was claimed again or cancelled while it ran
+            finished = db.session.execute(update(dbJob).where(dbJob.id == job.id, dbJob.status == "running", dbJob.locked_at == claimed)
+                                          .values(status="done", finished=datetime.now())
+                                          .execution_options(synchronize_session=False))
+            if finished.rowcount == 0:
+                db.session.rollback()
+            else:
+                db.session.commit()
+        except Exception as error:
+            db.session.rollback()
+            self.app.logger.exception("Job " + str(job.id) + " (" + job.kind + ") failed")
+            self.retry(job, claimed, error)
+        return True
+
+    def retry(self, job, claimed, error):
+        values = {"error": type(error).__name__ + ": " + str(error)}
+        if job.attempts >= self.maxattempts:
+            values["status"] = "failed"
+        else:
+            values["status"] = "queued"
+            values["run_after"] = datetime.now() + timedelta(seconds=self.backoff * 2 ** (job.attempts - 1))
+        db.session.execute(update(dbJob).where(dbJob.id == job.id, dbJob.locked_at == claimed).values(**values)
+                           .execution_options(synchronize_session=False))
+        db.session.commit()
+
+    #runs jobs until stop is set, sleeping between polls while there is nothing due
+    def work(self, stop=None):
+        with self.app.app_context():
+            while stop is None or not stop.is_set():
+                try:
+                    if self.runone():
+                        continue
+                    self.prune()
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception("Job worker error")
+                self.wake.wait(self.pollinterval)
+                self.wake.clear()
+
+    #runs every due job in this thread, then waits up to flushwait seconds for any still running in other workers
+    #a job left running by a worker that died isn't waited on for longer, claim takes it back once timeout has passed
+    def flush(self):
+        started = monotonic()
+        while True:
+            if self.runone():
+                continue
+            #a job retried without a backoff can fall due just after the claim looked
+            now = datetime.now()
+            due = dbJob.query.filter(dbJob.status == "queued", dbJob.run_after <= now).count()
+            running = dbJob.query.filter(dbJob.status == "running").count()
+            db.session.commit()
+            if due == 0 and (running == 0 or monotonic() - started >= self.flushwait):
+                return
+            sleep(0.01)
+
+    #deletes finished jobs after keepdays, so a key can't be queued again before then, failed jobs are kept
+    def prune(self):
+        now = datetime.now()
+        if self.pruned and now - self.pruned < timedelta(hours=1):
+            return
+        self.pruned = now
+        dbJob.query.filter(dbJob.status == "done", dbJob.finished < now - self.keep).delete(synchronize_session=False)
+        db.session.commit()
+
+#limits a query to orders placed from start (inclusive) up to end (exclusive), either can be None
+def daterange(query, start, end):
+    if start:
+        query = query.where(dbOrder.order_date >= start)
+    if end:
+        query = query.where(dbOrder.order_date < end)
+    return query
+
+class SalesReport():
+    #builds the admin sales report from the dbSales_Summary table
+    def __init__(self):
+        pass
+
+    #aggregates the order history per product in one grouped query, optionally for orders placed from start up to end
+    def rollup(self, start=None, end=None):
+        query = select(dbOrder_Item.product_id, func.sum(dbOrder_Item.quantity), func.sum(dbOrder_Item.price)) \
+            .join(dbProduct, dbProduct.id == dbOrder_Item.product_id)
+        if start or end:
+            query = daterange(query.join(dbOrder, dbOrder.id == dbOrder_Item.order_id), start, end)
+        return query.group_by(dbOrder_Item.product_id)
+
+    #recomputes the summary table from scratch (used when it is empty or out of sync)
+    def rebuild(self):
+        db.session.query(dbSales_Summary).delete()
+        db.session.execute(insert(dbSales_Summary).from_select(["product_id", "quantity", "revenue"], self.rollup()))
+        #orders whose sales jobs haven't run yet are counted now, so the jobs are cancelled in the same transaction
+        dbJob.query.filter(dbJob.kind == "sales", dbJob.status.in_(["queued", "running"])) \
+            .update({"status": "done", "finished": datetime.now()}, synchronize_session=False)
+        db.session.commit()
+
+    #adds an order's items to the running totals, run by the job queue after checkout
+    def recordsales(self, payload):
+        for productid, quantity, revenue in payload["items"]:
+            self.recordsale(productid, quantity, revenue)
+
+    #adds a sale to the running totals for a product
+    def recordsale(self, productid, quantity, revenue):
+        updated = dbSales_Summary.query.filter_by(product_id=productid).update({
+            dbSales_Summary.quantity: dbSales_Summary.quantity + quantity,
+            dbSales_Summary.revenue: dbSales_Summary.revenue + revenue})
+        if updated == 0:
+            #first sale of this product
+            db.session.add(dbSales_Summary(product_id=productid, quantity=quantity, revenue=revenue))
+
+    #reads the report, cost depends on the number of products not orders
+    #orders from before the summary table are added by a migration, so this only ever reads
+    def getreport(self):
+        rows = db.session.query(dbProduct.name, dbProduct.price, dbSales_Summary.quantity, dbSales_Summary.revenue) \
+            .join(dbSales_Summary, dbSales_Summary.product_id == dbProduct.id) \
+            .order_by(dbProduct.id).all()
+        return [SalesLine(name, quantity, price, revenue) for name, price, quantity, revenue in rows]
+
+#read-only copy of a product row, slotted and immutable so it can be shared between requests
+ProductSnapshot = namedtuple("ProductSnapshot", ["id", "name", "description", "image", "colour", "price", "stock"])
+
+class Catalog():
+    #in-memory copy of the product table shared by every request in this process
+    #other workers signal changes through dbCatalog_Version, which is checked at most every checkinterval seconds
+    def __init__(self, checkinterval):
+        self.checkinterval = checkinterval
+        self.products = {}
+        self.version = None
+        #counts reloads in this process, used to key the page cache
+        self.generation = 0
+        self.checked = 0
+        self.stale = True
+        self.lock = threading.Lock()
+        #any product written through the orm invalidates the catalog
+        for change in ["after_insert", "after_update", "after_delete"]:
+            event.listen(dbProduct, change, self.productchanged)
+
+    def productchanged(self, mapper, connection, target):
+        self.invalidate(connection)
+
+    #moves the shared version on so every worker reloads, runs inside the caller's transaction
+    def invalidate(self, connection=None):
+        self.stale = True
+        if connection is None:
+            connection = db.session
+        table = dbCatalog_Version.__table__
+        result = connection.execute(update(table).where(table.c.id == 1).values(version=table.c.version + 1))
+        if result.rowcount == 0:
+            connection.execute(insert(table).values(id=1, version=1))
+
+    #reads the shared version, 0 if nothing has changed yet
+    def currentversion(self):
+        version = db.session.query(dbCatalog_Version.version).filter_by(id=1).scalar()
+        return version or 0
+
+    #reloads the products if this process changed them or another worker moved the version on
+    def ensurefresh(self):
+        now = monotonic()
+        if not self.stale and now - self.checked < self.checkinterval:
+            return
+        with self.lock:
+            self.checked = now
+            stale = self.stale
+            self.stale = False
+            version = self.currentversion()
+            if stale or version != self.version:
+                products = {}
+                for product in dbProduct.query.order_by(dbProduct.id).all():
+                    products[product.id] = ProductSnapshot(product.id, product.name, product.description, product.image, product.colour, product.price, product.stock)
+                #swapped in whole so readers never see a half built catalog
+                self.products = products
+                self.version = version
+                self.generation += 1
+
+    def getversion(self):
+        #changes whenever the products are reloaded
+        self.ensurefresh()
+        return self.generation
+
+    def getproducts(self):
+        #gets every product in id order
+        self.ensurefresh()
+        return list(self.products.values())
+
+    def getproduct(self, productid):
+        #gets a single product, or None if it doesn't exist
+        self.ensurefresh()
+        return self.products.get(productid)
+
+class CachedPage:
+    #a rendered page with the validators needed to answer conditional requests
+    __slots__ = ("body", "etag", "lastmodified")
+
+    def __init__(self, body):
+        self.body = body
+        self.etag = hashlib.sha1(body.encode("utf-8")).hexdigest()
+        self.lastmodified = datetime.now(timezone.utc)
+
+class PageCache():
+    #least recently used cache of rendered pages
+    def __init__(self, maxsize):
+        self.pages = OrderedDict()
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+
+    #gets a page, or None if it hasn't been rendered for this key
+    def get(self, key):
+        with self.lock:
+            page = self.pages.get(key)
+            if page is not None:
+                self.pages.move_to_end(key)
+            return page
+
+    def put(self, key, body):
+        page = CachedPage(body)
+        with self.lock:
+            self.pages[key] = page
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.maxsize:
+                self.pages.popitem(last=False)
+        return page
+
+class OutOfStock(Exception):
+    #raised when a product in an order doesn't have enough stock left
+    def __init__(self, name):
+        super().__init__(name + " doesn't have enough stock left")
+        self.name = name
+
+class EmptyCart(Exception):
+    #raised when an order is placed with nothing in the cart
+    def __init__(self):
+        super().__init__("Your cart is empty")
+
+class RefNumbers():
+    #makes order reference numbers without asking the database
+    #SC- then 10 digits of unix time, 5 random digits and a luhn check digit
+    def __init__(self):
+        pass
+
+    def generate(self):
+        digits = str(int(datetime.now().timestamp())).zfill(10)[-10:] + str(secrets.randbelow(100000)).zfill(5)
+        return "SC-" + digits + str(self.checkdigit(digits))
+
+    #luhn check digit so a mistyped reference number can be told apart from a real one
+    def checkdigit(self, digits):
+        total = 0
+        for position, digit in enumerate(reversed(digits)):
+            value = int(digit)
+            if position % 2 == 0:
+                value *= 2
+                if value > 9:
+                    value -= 9
+            total += value
+        return (10 - total % 10) % 10
+
+class OrderWriter():
+    #writes a customer's order, its items and the stock changes in a single transaction
+    #the sales report and low stock warnings are left to the job queue
+    def __init__(self, salesreport, catalog, jobs, lowstocklevel):
+        self.salesreport = salesreport
+        self.catalog = catalog
+        self.jobs = jobs
+        self.lowstocklevel = lowstocklevel
+        self.refnumbers = RefNumbers()
+        jobs.register("sales", salesreport.recordsales)
+        jobs.register("lowstock", self.checkstock)
+
+    #places the order for everything in the cart, raises OutOfStock or EmptyCart and writes nothing on a shortfall
+    def placeorder(self, customerdetails, cart):
+        try:
+            return self.writeorder(customerdetails, cart, self.refnumbers.generate())
+        except IntegrityError:
+            #the unique index caught a clashing reference number (or a customer created at the same moment)
+            #so retry once, the whole order was rolled back
+            return self.writeorder(customerdetails, cart, self.refnumbers.generate())
+
+    def writeorder(self, customerdetails, cart, refnum):
+        items = cart.getproducts()
+        if not items:
+            raise EmptyCart()
+        order_date = datetime.now()
+        try:
+            #stock is taken first, so the write lock is held before anything is read
+            #and concurrent checkouts queue up instead of overselling
+            #a quantity below one would put stock back, so it is treated like a shortfall
+            #products this order takes from above the low stock level to at or below it
+            lowstock = []
+            for item in items:
+                stock = db.session.execute(
+                    update(dbProduct)
+                    .where(dbProduct.id == item.id, literal(item.quantity) > 0, dbProduct.stock >= item.quantity)
+                    .values(stock=dbProduct.stock - item.quantity)
+                    .returning(dbProduct.stock)
+                    .execution_options(synchronize_session=False)).scalar()
+                if stock is None:
+                    raise OutOfStock(item.name)
+                if stock <= self.lowstocklevel < stock + item.quantity:
+                    lowstock.append([item.name, stock])
+            #stock shown on the storefront has changed
+            self.catalog.invalidate()
+
+            #create new customer if they don't exist
+            customer = dbCustomer.query.filter_by(email=customerdetails["email"]).first()
+            if not customer:
+                customer = dbCustomer(**customerdetails)
+                db.session.add(customer)
+                db.session.flush()
+
+            order = dbOrder(ref_number=refnum, total_price=cart.gettotalprice(), order_date=order_date, shipping_date=order_date + timedelta(days=7), status="paid", customer_id=customer.id)
+            db.session.add(order)
+            db.session.flush()
+
+            #all the items go in with one executemany insert
+            db.session.execute(insert(dbOrder_Item), [
+                {"order_id": order.id, "product_id": item.id, "quantity": item.quantity, "price": item.total} for item in items])
+            #the jobs commit with the order, keyed by its reference number so they are only queued once
+            self.jobs.enqueue("sales", {"items": [[item.id, item.quantity, item.total] for item in items]}, key="sales:" + refnum)
+            if lowstock:
+                self.jobs.enqueue("lowstock", {"products": lowstock}, key="lowstock:" + refnum)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return order
+
+    #warns once about each product an order took down to the low stock level, the admin home lists them too
+    def checkstock(self, payload):
+        for name, stock in payload["products"]:
+            self.jobs.app.logger.warning("Low stock: %s is down to %d", name, stock)
+
+class Exporter():
+    #streams orders, order items and the sales report as csv or json lines
+    #rows are read from the database and sent a batch at a time, so memory stays flat however many there are
+    def __init__(self, salesreport, batchsize):
+        self.salesreport = salesreport
+        self.batchsize = batchsize
+        self.reports = {"orders": self.orders, "orderitems": self.orderitems, "sales": self.sales}
+        self.formats = {"csv": self.writecsv, "jsonl": self.writejsonl}
+
+    def orders(self, start, end):
+        query = select(dbOrder.id, dbOrder.ref_number, dbOrder.total_price, dbOrder.order_date, dbOrder.shipping_date,
+                       dbOrder.status, dbOrder.customer_id, dbCustomer.email) \
+            .outerjoin(dbCustomer, dbCustomer.id == dbOrder.customer_id)
+        return daterange(query, start, end).order_by(dbOrder.id)
+
+    def orderitems(self, start, end):
+        query = select(dbOrder_Item.id, dbOrder_Item.order_id, dbOrder.ref_number, dbOrder.order_date, dbOrder_Item.product_id,
+                       dbProduct.name, dbOrder_Item.quantity, dbOrder_Item.price) \
+            .join(dbOrder, dbOrder.id == dbOrder_Item.order_id) \
+            .outerjoin(dbProduct, dbProduct.id == dbOrder_Item.product_id)
+        return daterange(query, start, end).order_by(dbOrder_Item.id)
+
+    def sales(self, start, end):
+        if start is None and end is None:
+            #the running totals already cover the whole history
+            return select(dbSales_Summary.product_id, dbProduct.name, dbSales_Summary.quantity, dbSales_Summary.revenue) \
+                .join(dbProduct, dbProduct.id == dbSales_Summary.product_id).order_by(dbSales_Summary.product_id)
+        rollup = self.salesreport.rollup(start, end).subquery()
+        product_id, quantity, revenue = rollup.c
+        return select(product_id.label("product_id"), dbProduct.name, quantity.label("quantity"), revenue.label("revenue")) \
+            .join(dbProduct, dbProduct.id == product_id).order_by(product_id)
+
+    #yields the column names then each batch of rows, the header goes out before the query runs
+    def batches(self, report, start, end):
+        query = self.reports[report](start, end)
+        yield [column.key for column in query.selected_columns]
+        result = db.session.execute(query.execution_options(yield_per=self.batchsize))
+        for batch in result.partitions():
+            yield batch
+
+    def writecsv(self, batches):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(next(batches))
+        yield buffer.getvalue()
+        for batch in batches:
+            buffer.seek(0)
+            buffer.truncate(0)
+            writer.writerows(batch)
+            yield buffer.getvalue()
+
+    def writejsonl(self, batches):
+        columns = next(batches)
+        for batch in batches:
+            yield "".join(json.dumps(dict(zip(columns, row)), default=str) + "\n" for row in batch)
+
+    def stream(self, report, fmt, start=None, end=None):
+        return self.formats[fmt](self.batches(report, start, end))
+
+class ImportReport():
+    #counts from a product import, errors are (line, message) and only the first maxerrors are kept
+    def __init__(self, maxerrors=1000):
+        self.read = 0
+        self.inserted = 0
+        self.updated = 0
+        self.failed = 0
+        self.errors = []
+        self.maxerrors = maxerrors
+
+    def adderror(self, line, message):
+        self.failed += 1
+        if len(self.errors) < self.maxerrors:
+            self.errors.append((line, message))
+
+class ProductImporter():
+    #loads csv or json lines product feeds a chunk at a time, products with the same name are updated
+    #bulk writes skip the orm events, so each chunk invalidates the catalog itself
+    def __init__(self, catalog, chunksize):
+        self.catalog = catalog
+        self.chunksize = chunksize
+        self.validation = Validation()
+
+    #yields (line, row, error) for each row of the feed without reading it all in
+    def readrows(self, stream, fmt):
+        if fmt == "csv":
+            reader = csv.DictReader(stream)
+            try:
+                for row in reader:
+                    yield reader.line_num, row, None
+            except csv.Error as error:
+                yield reader.line_num, None, "Invalid csv: " + str(error)
+        else:
+            for line, content in enumerate(stream, 1):
+                if not content.strip():
+                    continue
+                try:
+                    row = json.loads(content)
+                except ValueError:
+                    yield line, None, "Invalid json"
+                    continue
+                if not isinstance(row, dict):
+                    yield line, None, "Each line must be a json object"
+                    continue
+                yield line, row, None
+
+    #returns the cleaned product fields and an error message, which is None if the row is valid
+    def checkrow(self, row):
+        values = {}
+        for field in ["name", "description", "image", "colour", "price", "stock"]:
+            values[field] = str(row.get(field) if row.get(field) is not None else "").strip()
+        for field in ["name", "colour", "price", "stock"]:
+            if values[field] == "":
+                return values, "Missing " + field
+        self.validation.reseterrors()
+        self.validation.maxlength("name", values["name"])
+        self.validation.maxlength("colour", values["colour"])
+        self.validation.isstring("colour", values["colour"])
+        self.validation.isprice("price", values["price"])
+        self.validation.iscount("stock", values["stock"])
+        errors = self.validation.geterrors()
+        if errors:
+            return values, ", ".join(errors)
+        values["price"] = float(values["price"])
+        values["stock"] = int(values["stock"])
+        return values, None
+
+    #inserts new products and updates existing ones by name, chunk is name -> (line, values)
+    def writechunk(self, chunk, report):
+        existing = dict(db.session.execute(select(dbProduct.name, dbProduct.id).where(dbProduct.name.in_(list(chunk)))).all())
+        inserts = []
+        updates = []
+        for name, (line, values) in chunk.items():
+            if name in existing:
+                values["id"] = existing[name]
+                #a blank image keeps the product's current one
+                if values["image"] == "":
+                    del values["image"]
+                updates.append(values)
+            elif values["image"] == "":
+                report.adderror(line, "Missing image")
+            else:
+                inserts.append(values)
+        try:
+            db.session.bulk_insert_mappings(dbProduct, inserts)
+            db.session.bulk_update_mappings(dbProduct, updates)
+            self.catalog.invalidate()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        report.inserted += len(inserts)
+        report.updated += len(updates)
+
+    #imports a text stream, progress is called with the report after every chunk
+    def load(self, stream, fmt, progress=None):
+        report = ImportReport()
+        chunk = {}
+        for line, row, error in self.readrows(stream, fmt):
+            report.read += 1
+            if error is None:
+                values, error = self.checkrow(row)
+            if error:
+                report.adderror(line, error)
+                continue
+            #a name repeated in the same chunk keeps its last row
+            chunk[values["name"]] = (line, values)
+            if len(chunk) >= self.chunksize:
+                self.writechunk(chunk, report)
+                chunk = {}
+                if progress:
+                    progress(report)
+        if chunk:
+            self.writechunk(chunk, report)
+            if progress:
+                progress(report)
+        return report
+
+#one item of an order with the name of its product
+OrderLine = namedtuple("OrderLine", ["productid", "name", "quantity", "price"])
+#what the order pages show, order and customer are loaded rows, lines are OrderLines
+OrderDetail = namedtuple("OrderDetail", ["order", "customer", "lines"])
+
+class OrderDetails():
+    #loads an order with its customer, items and their products in one query for the order pages
+    def byref(self, refnum):
+        return self.load(dbOrder.ref_number == refnum)
+
+    def byid(self, orderid):
+        return self.load(dbOrder.id == orderid)
+
+    def load(self, condition):
+        order = dbOrder.query.options(joinedload(dbOrder.customer_rel),
+                                      joinedload(dbOrder.orderitems).joinedload(dbOrder_Item.product_rel)) \
+            .filter(condition).first()
+        if order is None:
+            return None
+        lines = []
+        for item in order.orderitems:
+            #products can be deleted after they were ordered
+            name = item.product_rel.name if item.product_rel else "Product no longer available"
+            lines.append(OrderLine(item.product_id, name, item.quantity, item.price))
+        return OrderDetail(order, order.customer_rel, lines)
+
+class ImagePipeline():
+    #stores product images under a hash of their content and makes smaller webp copies on the job queue
+    #the same picture uploaded twice is only stored once, and a file never changes once written so it can be cached forever
+    def __init__(self, app, jobs, catalog, widths, assets, urlprefix="/static/uploads/"):
+        self.app = app
+        self.jobs = jobs
+        self.catalog = catalog
+        self.widths = widths
+        #StaticAssets, which fingerprints the urls put in pages
+        self.assets = assets
+        self.urlprefix = urlprefix
+        #images whose variants are known to exist
+        self.ready = set()
+        self.lock = threading.Lock()
+        jobs.register("imagevariants", self.variantjob)
+
+    #where an image url is stored on disk, None for images outside the upload folder
+    def filepath(self, url):
+        if not url.startswith(self.urlprefix):
+            return None
+        return path.join(self.app.config["UPLOAD_FOLDER"], url[len(self.urlprefix):])
+
+    def varianturl(self, url, width):
+        return path.splitext(url)[0] + "-" + str(width) + ".webp"
+
+    #saves an uploaded file and returns its url, the variants follow once the product using it is committed
+    def save(self, upload):
+        data = upload.read()
+        extension = path.splitext(secure_filename(upload.filename))[1].lower()
+        url = self.urlprefix + hashlib.sha256(data).hexdigest()[:24] + extension
+        filepath = self.filepath(url)
+        if not path.exists(filepath):
+            #written under a temporary name first so a half written file is never served
+            with open(filepath + ".tmp", "wb") as file:
+                file.write(data)
+            replace(filepath + ".tmp", filepath)
+        self.queue(url)
+        return url
+
+    def queue(self, url):
+        self.jobs.enqueue("imagevariants", {"url": url})
+
+    def variantjob(self, payload):
+        #the image may have been discarded before the job ran
+        if not path.exists(self.filepath(payload["url"])):
+            return
+        self.makevariants(payload["url"])
+        #moves the catalog version on so cached pages are rendered again with the variants
+        self.catalog.invalidate()
+
+    def makevariants(self, url):
+        with Image.open(self.filepath(url)) as image:
+            image.load()
+            for width in self.widths:
+                target = self.filepath(self.varianturl(url, width))
+                if path.exists(target):
+                    continue
+                variant = image.copy()
+                #keeps the aspect ratio and never makes an image bigger
+                variant.thumbnail((width, width * 4))
+                variant.save(target + ".tmp", "WEBP", quality=80)
+                replace(target + ".tmp", target)
+        with self.lock:
+            self.ready.add(url)
+
+    #waits until every queued image has its variants
+    def flush(self):
+        self.jobs.flush()
+
+    def hasvariants(self, url):
+        if url in self.ready:
+            return True
+        filepath = self.filepath(url)
+        #variants made by another worker or before a restart
+        if filepath and all(path.exists(self.filepath(self.varianturl(url, width))) for width in self.widths):
+            with self.lock:
+                self.ready.add(url)
+            return True
+        return False
+
+    #the srcset attribute value for an image, empty until its variants exist
+    def srcset(self, url):
+        if not self.hasvariants(url):
+            return ""
+        return ", ".join(self.assets.url(self.varianturl(url, width)) + " " + str(width) + "w" for width in self.widths)
+
+    #the variant closest to width, or the original image while the variants are being made
+    def variant(self, url, width):
+        if not self.hasvariants(url):
+            return self.assets.url(url)
+        return self.assets.url(self.varianturl(url, min(self.widths, key=lambda size: abs(size - width))))
+
+    #deletes an image and its variants once no product uses it, call after the change is committed
+    def discard(self, url):
+        filepath = self.filepath(url)
+        if filepath is None or dbProduct.query.filter_by(image=url).first():
+            return
+        for imageurl in [url] + [self.varianturl(url, width) for width in self.widths]:
+            try:
+                remove(self.filepath(imageurl))
+            except FileNotFoundError:
+                pass
+            #so the old fingerprinted link is no longer served from the manifest
+            self.assets.forget(imageurl)
+        with self.lock:
+            self.ready.discard(url)
+
+#a fingerprinted static file, gzip and brotli are paths of compressed copies or None
+Asset = namedtuple("Asset", ["fingerprint", "filepath", "mtime", "gzip", "brotli"])
+
+class StaticAssets():
+    #fingerprints static files so their urls change with their content and browsers can cache them for a year
+    #text files are compressed once up front and the smaller copy goes to browsers that accept it
+    def __init__(self, app, cachefolder, maxage, skip="uploads"):
+        self.app = app
+        self.cachefolder = cachefolder
+        self.maxage = maxage
+        #static filename -> Asset, files under skip are added the first time they are linked to
+        self.manifest = {}
+        makedirs(cachefolder, exist_ok=True)
+        for folder, _, files in walk(app.static_folder):
+            for name in files:
+                filename = path.relpath(path.join(folder, name), app.static_folder).replace(path.sep, "/")
+                if not filename.startswith(skip + "/"):
+                    self.add(filename)
+
+    def add(self, filename):
+        filepath = safe_join(self.app.static_folder, filename)
+        if filepath is None or not path.isfile(filepath):
+            return None
+        mtime = stat(filepath).st_mtime
+        with open(filepath, "rb") as file:
+            data = file.read()
+        fingerprint = hashlib.sha256(data).hexdigest()[:16]
+        compressed = {"gzip": None, "brotli": None}
+        mimetype = mimetypes.guess_type(filename)[0] or ""
+        if mimetype.startswith("text/") or mimetype in ["application/javascript", "application/json", "image/svg+xml"]:
+            compressed["gzip"] = self.compress(fingerprint, filename, ".gz", gzip.compress(data, 9, mtime=0), len(data))
+            compressed["brotli"] = self.compress(fingerprint, filename, ".br", brotli.compress(data), len(data))
+        asset = Asset(fingerprint, filepath, mtime, compressed["gzip"], compressed["brotli"])
+        self.manifest[filename] = asset
+        return asset
+
+    #keeps a compressed copy named after the fingerprint, unless it barely saves anything
+    def compress(self, fingerprint, filename, suffix, data, size):
+        if len(data) > size * 0.9:
+            return None
+        target = path.join(self.cachefolder, fingerprint + "-" + path.basename(filename) + suffix)
+        if not path.exists(target):
+            with open(target + ".tmp", "wb") as file:
+                file.write(data)
+            replace(target + ".tmp", target)
+        return target
+
+    def lookup(self, filename):
+        asset = self.manifest.get(filename)
+        #files edited while developing get a new fingerprint without a restart
+        if asset is None or (self.app.debug and stat(asset.filepath).st_mtime != asset.mtime):
+            asset = self.add(filename)
+        return asset
+
+    def fingerprint(self, filename):
+        asset = self.lookup(filename)
+        if asset:
+            return asset.fingerprint
+        return None
+
+    #adds the fingerprint to a /static url kept as text, like product images
+    def url(self, url):
+        if not url.startswith("/static/"):
+            return url
+        fingerprint = self.fingerprint(url[len("/static/"):])
+        if fingerprint is None:
+            return url
+        return url + "?v=" + fingerprint
+
+    #drops a /static url from the manifest once its file is deleted
+    def forget(self, url):
+        if url.startswith("/static/"):
+            self.manifest.pop(url[len("/static/"):], None)
+
+    #replaces flask's static view, send_file lets the server use sendfile for the body
+    def serve(self, filename):
+        asset = self.lookup(filename)
+        if asset is not None and not path.isfile(asset.filepath):
+            #deleted since it was added, flask's static view answers with a 404
+            self.manifest.pop(filename, None)
+            asset = None
+        if asset is None or request.args.get("v") != asset.fingerprint:
+            #links without the current fingerprint are served as before and revalidated
+            return self.app.send_static_file(filename)
+        filepath = asset.filepath
+        encoding = None
+        if asset.brotli and "br" in request.accept_encodings:
+            filepath, encoding = asset.brotli, "br"
+        elif asset.gzip and "gzip" in request.accept_encodings:
+            filepath, encoding = asset.gzip, "gzip"
+        response = send_file(filepath, mimetype=mimetypes.guess_type(filename)[0], max_age=self.maxage,
+                             etag=asset.fingerprint + (encoding or ""), conditional=True)
+        if encoding:
+            response.content_encoding = encoding
+        response.vary.add("Accept-Encoding")
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+class RequestMetrics:
+    #timings gathered while one request runs, statements counts each distinct sql string
+    __slots__ = ("start", "queries", "dbtime", "templatetime", "renderstart", "statements")
+
+    def __init__(self, start):
+        self.start = start
+        self.queries = 0
+        self.dbtime = 0
+        self.templatetime = 0
+        self.renderstart = None
+        self.statements = {}
+
+class EndpointStats:
+    #running totals for one endpoint, buckets[i] counts requests no slower than Metrics.buckets[i]
+    __slots__ = ("buckets", "count", "seconds", "queries", "dbseconds", "templateseconds", "bytes", "flagged")
+
+    def __init__(self, size):
+        self.buckets = [0] * size
+        self.count = 0
+        self.seconds = 0
+        self.queries = 0
+        self.dbseconds = 0
+        self.templateseconds = 0
+        self.bytes = 0
+        self.flagged = 0
+
+class Metrics():
+    #per endpoint latency histograms with sql, template and response size totals, read by prometheus
+    #requests running more than querybudget statements, or one statement more than repeatlimit times, are logged as likely n+1s
+    buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self, querybudget, repeatlimit):
+        self.querybudget = querybudget
+        self.repeatlimit = repeatlimit
+        self.endpoints = {}
+        self.lock = threading.Lock()
+        self.app = None
+
+    #hooks into the app and engines, when metrics are turned off this is never called so nothing runs
+    def attach(self, app, engines):
+        self.app = app
+        app.before_request(self.startrequest)
+        app.after_request(self.finishrequest)
+        before_render_template.connect(self.startrender, app)
+        template_rendered.connect(self.finishrender, app)
+        for engine in engines:
+            event.listen(engine, "before_cursor_execute", self.startquery)
+            event.listen(engine, "after_cursor_execute", self.finishquery)
+
+    def startrequest(self):
+        g.metrics = RequestMetrics(perf_counter())
+
+    def startquery(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info["querystart"] = perf_counter()
+
+    def finishquery(self, conn, cursor, statement, parameters, context, executemany):
+        #background threads have no request to charge the query to
+        if not has_request_context() or "metrics" not in g:
+            return
+        metrics = g.metrics
+        metrics.queries += 1
+        metrics.dbtime += perf_counter() - conn.info.pop("querystart", perf_counter())
+        metrics.statements[statement] = metrics.statements.get(statement, 0) + 1
+
+    def startrender(self, sender, template, context, **extra):
+        if "metrics" in g:
+            g.metrics.renderstart = perf_counter()
+
+    def finishrender(self, sender, template, context, **extra):
+        if "metrics" in g and g.metrics.renderstart is not None:
+            g.metrics.templatetime += perf_counter() - g.metrics.renderstart
+            g.metrics.renderstart = None
+
+    def finishrequest(self, response):
+        metrics = g.pop("metrics", None)
+        if metrics is None:
+            return response
+        elapsed = perf_counter() - metrics.start
+        self.record(request.endpoint or "unmatched", elapsed, metrics, response.content_length or 0)
+        response.headers["Server-Timing"] = 'app;dur={:.1f}, db;dur={:.1f};desc="{} queries", tpl;dur={:.1f}'.format(
+            elapsed * 1000, metrics.dbtime * 1000, metrics.queries, metrics.templatetime * 1000)
+        return response
+
+    def record(self, endpoint, elapsed, metrics, size):
+        repeated = max(metrics.statements.values(), default=0)
+        flagged = metrics.queries > self.querybudget or repeated > self.repeatlimit
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = EndpointStats(len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if elapsed <= bound:
+                    stats.buckets[i] += 1
+            stats.count += 1
+            stats.seconds += elapsed
+            stats.queries += metrics.queries
+            stats.dbseconds += metrics.dbtime
+            stats.templateseconds += metrics.templatetime
+            stats.bytes += size
+            stats.flagged += flagged
+        if flagged:
+            statement = max(metrics.statements, key=metrics.statements.get)
+            self.app.logger.warning("Possible N+1 queries on %s: %d statements, this one %d times: %s",
+                                    endpoint, metrics.queries, repeated, " ".join(statement.split())[:200])
+
+    #the prometheus text format
+    def export(self):
+        counters = [("sql_queries_total", "counter", "SQL statements run", "queries"),
+                    ("sql_seconds_total", "counter", "Time spent running SQL", "dbseconds"),
+                    ("template_seconds_total", "counter", "Time spent rendering templates", "templateseconds"),
+                    ("response_bytes_total", "counter", "Response body bytes, streamed bodies are not counted", "bytes"),
+                    ("query_budget_exceeded_total", "counter", "Requests flagged as likely N+1 queries", "flagged")]
+        lines = ["# HELP slimeshop_request_seconds Request latency", "# TYPE slimeshop_request_seconds histogram"]
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            for endpoint, stats in endpoints:
+                label = 'endpoint="' + endpoint + '"'
+                for bound, count in zip(self.buckets, stats.buckets):
+                    lines.append('slimeshop_request_seconds_bucket{' + label + ',le="' + str(bound) + '"} ' + str(count))
+                lines.append('slimeshop_request_seconds_bucket{' + label + ',le="+Inf"} ' + str(stats.count))
+                lines.append("slimeshop_request_seconds_sum{" + label + "} " + repr(stats.seconds))
+                lines.append("slimeshop_request_seconds_count{" + label + "} " + str(stats.count))
+            for name, kind, description, field in counters:
+                lines.append("# HELP slimeshop_" + name + " " + description)
+                lines.append("# TYPE slimeshop_" + name + " " + kind)
+                for endpoint, stats in endpoints:
+                    lines.append("slimeshop_" + name + '{endpoint="' + endpoint + '"} ' + repr(getattr(stats, field)))
+        return "\n".join(lines) + "\n"
+
+class LoginWindow:
+    #login attempts from one ip against one admin account, counted from start
+    __slots__ = ("start", "attempts")
+
+    def __init__(self, start, attempts):
+        self.start = start
+        self.attempts = attempts
+
+class LoginThrottle():
+    #counts login attempts per admin and ip in memory, a window over the limit is turned away without the database
+    #below maxattempts the saved count, which every worker adds to, is read as well, one lookup on the unique index
+    #every change is written to dbLogin_Event in the request, queued changes could land after a later reset
+    def __init__(self, app, jobs, window, maxentries, maxattempts):
+        self.app = app
+        self.jobs = jobs
+        self.window = timedelta(seconds=window)
+        self.maxattempts = maxattempts
+        self.maxentries = maxentries
+        #ordered from oldest to newest window
+        self.windows = OrderedDict()
+        self.lock = threading.Lock()
+        #events queued before they were written in the request still need writing
+        jobs.register("loginevent", self.writeevent)
+
+    #gets the open window for an admin and ip, looking in the database if this process hasn't seen it
+    def getwindow(self, adminid, ip):
+        now = datetime.now()
+        with self.lock:
+            window = self.windows.get((adminid, ip))
+        if window is not None and now <= window.start + self.window:
+            return window
+        #uses the (admin_id, ip_address, timestamp) index
+        event = dbLogin_Event.query.filter(dbLogin_Event.admin_id == adminid, dbLogin_Event.ip_address == ip,
+                                           dbLogin_Event.timestamp >= now - self.window, dbLogin_Event.timestamp <= now) \
+            .order_by(dbLogin_Event.timestamp).first()
+        if event is None:
+            return None
+        window = LoginWindow(event.timestamp, event.attempts)
+        self.store((adminid, ip), window)
+        return window
+
+    #keeps a window in memory, dropping expired windows and the oldest ones over the limit
+    def store(self, key, window):
+        cutoff = datetime.now() - self.window
+        with self.lock:
+            self.windows[key] = window
+            self.windows.move_to_end(key)
+            while self.windows:
+                oldest = next(iter(self.windows.values()))
+                if len(self.windows) > self.maxentries or oldest.start < cutoff:
+                    self.windows.popitem(last=False)
+                else:
+                    break
+
+    #returns how many attempts there have been in the current window
+    def attempts(self, adminid, ip):
+        window = self.getwindow(adminid, ip)
+        if window is None:
+            return 0
+        if window.attempts < self.maxattempts:
+            #attempts made through other workers only show up in the saved row, one lookup on the unique index
+            saved = db.session.query(dbLogin_Event.attempts) \
+                .filter_by(admin_id=adminid, ip_address=ip, timestamp=window.start).scalar()
+            if saved is not None and saved > window.attempts:
+                window.attempts = saved
+        return window.attempts
+
+    def record(self, adminid, ip, message, severity):
+        window = self.getwindow(adminid, ip)
+        if window and message == "Unsuccesful Login Attempt": #if unsuccessful
+            window.attempts += 1 #increment attempts
+            self.persist(adminid, ip, window, message, severity, "add")
+        elif window and message == "Succesful Login Attempt": #if successful
+            window.attempts = 0 #reset attempts
+            self.persist(adminid, ip, window, message, severity, "reset")
+        else:
+            #record new login attempt, it only opens a window if there isn't one already
+            newwindow = LoginWindow(datetime.now(), 1)
+            if window is None:
+                self.store((adminid, ip), newwindow)
+            self.persist(adminid, ip, newwindow, message, severity, "add")
+
+    #saves the change to the window's count, "add" for one more attempt or "reset" back to none
+    def persist(self, adminid, ip, window, message, severity, change):
+        self.writeevent({"adminid": adminid, "ip": ip, "start": window.start.isoformat(), "change": change,
+                         "message": message, "severity": severity})
+        db.session.commit()
+
+    #each window is one row, unique on (admin_id, ip_address, timestamp)
+    #adding rather than overwriting the count keeps it right when several workers' jobs commit in any order
+    def writeevent(self, payload):
+        added = payload["change"] == "add"
+        statement = sqliteinsert(dbLogin_Event).values(
+            timestamp=datetime.fromisoformat(payload["start"]), attempts=1 if added else 0, ip_address=payload["ip"],
+            action_details=payload["message"], severity=payload["severity"], admin_id=payload["adminid"])
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=["admin_id", "ip_address", "timestamp"],
+            set_={"attempts": dbLogin_Event.attempts + 1 if added else 0}))
+
+    #waits until any queued login event has been written
+    def flush(self):
+        self.jobs.flush()
+
+class PasswordsBusy(Exception):
+    #raised when too many password checks are already waiting for the pool
+    def __init__(self):
+        super().__init__("Too many login attempts right now, please try again shortly")
+
+class PasswordPool():
+    #runs bcrypt on a few dedicated threads so a burst of logins can't tie up every request thread
+    #bcrypt releases the gil while it works, so the threads hash in parallel
+    def __init__(self, workers, maxqueue, timeout):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.maxqueue = maxqueue
+        self.timeout = timeout
+        #checks running or waiting in the pool
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    #hands work to the pool, turning it away straight away if too much is already waiting
+    def run(self, function, *args):
+        with self.lock:
+            if self.pending >= self.maxqueue:
+                raise PasswordsBusy()
+            self.pending += 1
+        future = self.pool.submit(function, *args)
+        future.add_done_callback(self.finished)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            raise PasswordsBusy()
+
+    def finished(self, future):
+        with self.lock:
+            self.pending -= 1
+
+    def checkpw(self, password, hashed):
+        return self.run(bcrypt.checkpw, password.encode('utf-8'), hashed)
+
+    def hashpw(self, password):
+        return self.run(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt())
+
+#one page of an admin list, after is the id to continue from or None on the last page
+#restarted is set when the row the page should follow has gone, so the first page was given instead
+Page = namedtuple("Page", ["items", "total", "after", "restarted"])
+
+class Pager():
+    #pages through sorted queries by seeking past the last row shown, so later pages cost the same as the first
+    def __init__(self, pagesize, countttl):
+        self.pagesize = pagesize
+        self.countttl = countttl
+        #count key -> (expires, count)
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    #counting a big table is a full scan so totals are reused for a short while
+    def count(self, query, key):
+        now = monotonic()
+        with self.lock:
+            cached = self.counts.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+        total = query.order_by(None).count()
+        with self.lock:
+            if len(self.counts) > 1000:
+                self.counts = {k: v for k, v in self.counts.items() if v[0] > now}
+            self.counts[key] = (now + self.countttl, total)
+        return total
+
+    #query must be ordered by (column, id) in the given direction, as sorter builds it
+    #column can be a search rank as well as a table column, so the last value is read back through the query
+    def page(self, query, table, column, order, after, countkey):
+        total = self.count(query, countkey)
+        restarted = False
+        if after and column is table.id:
+            #sorted by id alone, the position is known even if that row has since been deleted
+            query = self.seek(query, table, column, order, after, after)
+        elif after:
+            last = query.with_entities(column).filter(table.id == after).first()
+            if last is None:
+                #the row was deleted or no longer matches the search, so its place in the order is unknown
+                restarted = True
+            else:
+                query = self.seek(query, table, column, order, last[0], after)
+        #one extra row says whether there is another page
+        rows = query.limit(self.pagesize + 1).all()
+        if len(rows) > self.pagesize:
+            return Page(rows[:self.pagesize], total, rows[self.pagesize - 1].id, restarted)
+        return Page(rows, total, None, restarted)
+
+    #keeps the rows after (value, after) in the sort order
+    #sqlite sorts nulls first when ascending and last when descending, and a tuple comparison with a null matches nothing
+    def seek(self, query, table, column, order, value, after):
+        if not getattr(column.expression, "nullable", True):
+            #the plain comparison can walk the column's index
+            if order == 'asc':
+                return query.filter(tuple_(column, table.id) > tuple_(value, after))
+            return query.filter(tuple_(column, table.id) < tuple_(value, after))
+        if order == 'asc':
+            if value is None:
+                return query.filter(or_(and_(column.is_(None), table.id > after), column.isnot(None)))
+            return query.filter(tuple_(column, table.id) > tuple_(value, after))
+        if value is None:
+            return query.filter(column.is_(None), table.id < after)
+        return query.filter(or_(tuple_(column, table.id) < tuple_(value, after), column.is_(None)))
+
+class TextSearch():
+    #searches the admin lists through the trigram fts5 tables set up in models
+    def __init__(self):
+        self.tables = {
+            dbProduct: ("product_search", ["name", "description", "colour"]),
+            dbOrder: ("order_search", ["ref_number", "status", "customer"]),
+        }
+
+    #ids of the rows matching the search with their bm25 rank, lower ranks are better matches
+    def matches(self, table, searchitem):
+        name, columns = self.tables[table]
+        if len(searchitem) >= 3:
+            #the search is one quoted phrase so fts5 syntax typed into the box is matched literally
+            sql = text("SELECT rowid AS id, bm25(" + name + ") AS rank FROM " + name + " WHERE " + name + " MATCH :phrase")
+            sql = sql.bindparams(phrase='"' + searchitem.replace('"', '""') + '"')
+        else:
+            #trigrams need 3 characters, shorter searches scan the index text instead
+            like = "%" + searchitem.replace("!", "!!").replace("%", "!%").replace("_", "!_") + "%"
+            where = " OR ".join(column + " LIKE :like ESCAPE '!'" for column in columns)
+            sql = text("SELECT rowid AS id, 0.0 AS rank FROM " + name + " WHERE " + where).bindparams(like=like)
+        return sql.columns(id=Integer, rank=Float).subquery("matches")
 
 class Validation():
     #handles input validation and the filter function
     def __init__(self):
         self.errors = []
+        self.search = TextSearch()
 
     #resets the errors list
     def reseterrors(self):
@@ -151,6 +1491,23 @@ class Validation():
         except ValueError:
             self.errors.append("Invalid " + field)
 
+    #checks that field is a price that isn't negative
+    def isprice(self, field, price):
+        try:
+            #inf, nan and values too big for a float can't be turned into pence
+            if not math.isfinite(float(price)) or float(price) < 0:
+                self.errors.append("Invalid " + field)
+        except ValueError:
+            self.errors.append("Invalid " + field)
+
+    #checks that field is a whole number that isn't negative
+    def iscount(self, field, number):
+        try:
+            if int(number) < 0:
+                self.errors.append("Invalid " + field)
+        except ValueError:
+            self.errors.append("Invalid " + field)
+
     #checks that field doesn't exceed 255 characters
     def maxlength(self, field, input):
         if len(input) > 255:
@@ -161,47 +1518,157 @@ class Validation():
         return self.errors
     
     #filter and sorter function for admin products/orders
+    #builds the filter query and returns it with the column it is sorted on
+    #rows are only fetched a page at a time by Pager, column None sorts by relevance
     def sorter(self, column, order, table, searchitem):
-        #retrieve all rows which have the search item
-        to_order = table.query.filter(column.contains(searchitem))
-        #if the search field is blank, return all but order asc/desc
-        if searchitem == "" :
-            if order == 'asc':
-                query = table.query.order_by(column.asc()).all()  
-            else:
-                query = table.query.order_by(column.desc()).all()
-        elif to_order == []:
-            query = []
-        else:
-            #return sorted rows that contain the search query 
-            if order == 'asc':
-                query = table.query.filter(column.contains(searchitem)).order_by(column.asc())  
-            else:
-                query = table.query.filter(column.contains(searchitem)).order_by(column.desc())
-        return query 
+        query = table.query
+        #if the search field isn't blank, only keep rows which have the search item
+        if searchitem:
+            matches = self.search.matches(table, searchitem)
+            query = query.join(matches, matches.c.id == table.id)
+            if column is None:
+                column = matches.c.rank
+        if column is None:
+            column = table.id
+        #id breaks ties so every row has a fixed place to page from
+        if order == 'asc':
+            return query.order_by(column.asc(), table.id.asc()), column
+        return query.order_by(column.desc(), table.id.desc()), column
 
 
-#converts the currency
+#one immutable set of exchange rates, replaced whole when the rates file changes
+RateSnapshot = namedtuple("RateSnapshot", ["version", "rates"])
+
+#converts the currency, the chosen currency is kept in each visitor's session
 class CurrencyConverter():
-    def __init__(self):
+    def __init__(self, ratesfile=None, checkinterval=30):
         #default currency gbp
-        self.currentcurrency = 3
+        self.defaultcurrency = 3
         self.currencies = ["USD", "EUR", "JPY", "GBP", "AUD", "CAD", "CHF", "CNY"]
         self.symbols = ["$", "€", "¥", "£", "$", "$", "₣", "¥"]
+        #used for any currency the rates file doesn't mention
         self.rateagainstpound = ["1.23","1.15","168.75","1","1.88","1.67","1.11","10.12"]
+        #yen has no minor unit
+        self.minordigits = [2, 2, 0, 2, 2, 2, 2, 2]
+        #rates file is json of currency code -> rate against the pound, e.g. {"USD": "1.25"}
+        self.ratesfile = ratesfile
+        self.checkinterval = checkinterval
+        self.checked = monotonic()
+        self.modified = None
+        self.snapshot = RateSnapshot(0, tuple(Decimal(rate) for rate in self.rateagainstpound))
+        self.reload()
+
+    #builds a new snapshot if the rates file has changed and swaps it in
+    #readers just take self.snapshot, so they never wait on a lock
+    def reload(self):
+        if not self.ratesfile:
+            return
+        try:
+            modified = stat(self.ratesfile).st_mtime_ns
+            if modified == self.modified:
+                return
+            with open(self.ratesfile) as ratesfile:
+                newrates = json.load(ratesfile)
+            rates = tuple(Decimal(str(newrates.get(code, default))) for code, default in zip(self.currencies, self.rateagainstpound))
+        except (OSError, ValueError, ArithmeticError):
+            #a missing or half written file keeps the current rates
+            return
+        self.modified = modified
+        self.snapshot = RateSnapshot(self.snapshot.version + 1, rates)
+
+    #returns the current rate snapshot, checking the rates file at most every checkinterval seconds
+    def getrates(self):
+        now = monotonic()
+        if now - self.checked > self.checkinterval:
+            self.checked = now
+            self.reload()
+        return self.snapshot
 
     #sets new currency that the user is using
     def setnew(self,new):
-        self.currentcurrency = int(new)
+        session["currency"] = int(new)
+
+    #returns the index of the current currency
+    def getcurrency(self):
+        return session.get("currency", self.defaultcurrency)
 
     #returns the current currency
     def currency(self):
-        return(str(self.currentcurrency))
+        return(str(self.getcurrency()))
     
     #returns the current rate
     def currentrate(self):
-        return float(self.rateagainstpound[self.currentcurrency])
+        return float(self.getrates().rates[self.getcurrency()])
     
     #returns the current symbol
     def currentsymbol(self):
-        return self.symbols[self.currentcurrency]
\ No newline at end of file
+        return self.symbols[self.getcurrency()]
+
+#every product price converted into every currency, in whole minor units
+#rebuilt only when the catalog changes so pages never multiply prices while rendering
+class PriceTable():
+    def __init__(self, catalog, converter):
+        self.catalog = catalog
+        self.converter = converter
+        self.version = None
+        self.rates = converter.getrates().rates
+        #one dict per currency of product id -> price
+        self.minor = []
+        self.formatted = []
+        self.lock = threading.Lock()
+
+    #rebuilds the table when the catalog or the exchange rates have changed
+    def ensurefresh(self):
+        rates = self.converter.getrates()
+        version = (self.catalog.getversion(), rates.version)
+        if version == self.version:
+            return
+        with self.lock:
+            if version == self.version:
+                return
+            products = self.catalog.getproducts()
+            self.rates = rates.rates
+            #a price that can't be converted (inf, nan) is left out rather than failing every page
+            priced = []
+            for product in products:
+                try:
+                    self.tominor(product.price, 0)
+                    priced.append(product)
+                except (InvalidOperation, ValueError):
+                    current_app.logger.warning("Product %s has an invalid price %r, left out of the price table", product.id, product.price)
+            minor = []
+            formatted = []
+            for currency in range(len(self.converter.currencies)):
+                prices = {product.id: self.tominor(product.price, currency) for product in priced}
+                minor.append(prices)
+                formatted.append({productid: self.format(price, currency) for productid, price in prices.items()})
+            #swapped in whole so readers never see a half built table
+            self.minor = minor
+            self.formatted = formatted
+            self.version = version
+
+    #converts a price in pounds to minor units of a currency
+    def tominor(self, price, currency):
+        return tominor(price, self.rates[currency], self.converter.minordigits[currency])
+
+    #turns minor units back into a displayable amount, e.g. 1299 -> 12.99
+    def format(self, minor, currency):
+        return str(Decimal(minor).scaleb(-self.converter.minordigits[currency]))
+
+    def getprices(self, currency):
+        #gets product id -> displayable price for every product
+        self.ensurefresh()
+        return self.formatted[currency]
+
+    #gets the displayable line totals and cart total, each line is quantity * the converted unit price
+    def cartprices(self, cart, currency):
+        self.ensurefresh()
+        linetotals = {}
+        total = 0
+        for product in cart.getproducts():
+            unit = self.minor[currency].get(product.id)
+            if unit is None:
+                unit = self.tominor(product.price, currency)
+            linetotals[product.id] = self.format(unit * product.quantity, currency)
+            total += unit * product.quantity
+        return linetotals, self.format(total, currency)
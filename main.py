@@ -1,18 +1,79 @@
-from flask import Flask, request, render_template, redirect, url_for, session
+from flask import Flask, request, render_template, redirect, url_for, session, make_response, Response, stream_with_context, g
 from werkzeug.utils import secure_filename
 import secrets 
-import bcrypt
+import codecs
+import math
+import click
 from models import *
 from library import *
 from datetime import *
-from random import *
 from os import *
 
 #configures the app including secret key, database and upload folder path
 app = Flask(__name__)
-app.config["SECRET_KEY"] = secrets.token_hex(16)
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + path.join(app.instance_path, 'slimeapp.db')
+#every worker process needs the same key to read each other's session cookies
+app.config["SECRET_KEY"] = environ.get("SECRET_KEY", secrets.token_hex(16))
+app.config["SQLALCHEMY_DATABASE_URI"] = environ.get("DATABASE_URL", "sqlite:///" + path.join(app.instance_path, 'slimeapp.db'))
+#set SQLITE_TUNING=0 to use sqlite's defaults
+app.config["SQLITE_TUNING"] = environ.get("SQLITE_TUNING", "1") == "1"
+#WAL lets readers carry on while a checkout commits, and NORMAL only syncs at checkpoints which is still safe in WAL mode
+app.config["SQLITE_PRAGMAS"] = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024, #read through memory mapping rather than read calls
+    "cache_size": -64 * 1024, #negative sizes are in KiB, so 64MB per connection
+    "busy_timeout": 5000, #milliseconds a writer waits for the lock before giving up
+    "temp_store": "MEMORY",
+}
+#read only routes use this, a replica's url or by default a read only connection to the main database
+app.config["SQLALCHEMY_BINDS"] = {"replica": environ.get("DATABASE_READ_URL", readonlyurl(app.config["SQLALCHEMY_DATABASE_URI"]))}
+app.config["READ_STICKY_SECONDS"] = 10 #after a post the visitor reads from the primary for this long
+#set METRICS_ENABLED=0 to skip all request timing
+app.config["METRICS_ENABLED"] = environ.get("METRICS_ENABLED", "1") == "1"
+app.config["METRICS_TOKEN"] = environ.get("METRICS_TOKEN", "") #lets a scraper read /admin/metrics without logging in
+app.config["QUERY_BUDGET"] = 20 #requests running more sql statements than this are logged
+app.config["QUERY_REPEAT_LIMIT"] = 10 #as are requests running the same statement more times than this
+#one connection per request thread, plus the background writers
+app.config["DB_POOL_SIZE"] = int(environ.get("DB_POOL_SIZE", 10))
+if app.config["SQLITE_TUNING"]:
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {"pool_size": app.config["DB_POOL_SIZE"], "max_overflow": 5, "pool_timeout": 10}
 app.config["UPLOAD_FOLDER"] = path.join("static", "uploads")
+#"database" shares carts between worker processes, "memory" keeps them in this process only
+app.config["CART_BACKEND"] = environ.get("CART_BACKEND", "database")
+app.config["CART_TTL"] = 60 * 60 * 24 * 2 #abandoned carts are dropped after 2 days
+app.config["CART_MAX"] = 10000 #most carts the memory backend holds at once
+app.config["CATALOG_CHECK_INTERVAL"] = 2 #seconds between checks for product changes made by other workers
+app.config["PAGE_CACHE_SIZE"] = 256 #most rendered storefront pages kept in memory
+#exchange rates can be changed at runtime by editing this file, see CurrencyConverter
+app.config["RATES_FILE"] = path.join(app.instance_path, "rates.json")
+app.config["RATES_CHECK_INTERVAL"] = 30 #seconds between checks for a new rates file
+app.config["LOGIN_WINDOW"] = 600 #seconds that failed login attempts are counted for
+app.config["LOGIN_THROTTLE_SIZE"] = 10000 #most admin and ip pairs tracked in memory
+app.config["LOGIN_MAX_ATTEMPTS"] = 5 #failed logins per admin and ip, across all workers, before the account is locked for the window
+app.config["PASSWORD_WORKERS"] = 2 #threads that run bcrypt
+app.config["PASSWORD_QUEUE"] = 8 #most password checks running or waiting before logins are turned away
+app.config["PASSWORD_TIMEOUT"] = 5 #seconds a login waits for its password check
+app.config["ADMIN_PAGE_SIZE"] = 50 #rows per page on the admin product and order lists
+app.config["ADMIN_COUNT_TTL"] = 30 #seconds an admin list total is reused for
+app.config["EXPORT_BATCH_SIZE"] = 1000 #rows read from the database per batch when exporting
+app.config["IMPORT_CHUNK_SIZE"] = 2000 #products written per transaction when importing a feed
+app.config["IMAGE_WIDTHS"] = [160, 320, 640] #widths of the smaller copies made of each product image
+app.config["LOW_STOCK_LEVEL"] = 10 #products with this many or fewer left are flagged to admins
+#the schema is brought up to date when the app starts, set MIGRATE_ON_START=0 when flask migrate is run before each deploy instead
+app.config["MIGRATE_ON_START"] = environ.get("MIGRATE_ON_START", "1") == "1"
+#set JOBS_IN_PROCESS=0 when separate flask runjobs workers run the background jobs
+app.config["JOBS_IN_PROCESS"] = environ.get("JOBS_IN_PROCESS", "1") == "1"
+app.config["JOB_MAX_ATTEMPTS"] = 5 #tries before a job is left as failed
+app.config["JOB_BACKOFF"] = 5 #seconds before the first retry, doubled for each one after
+app.config["JOB_TIMEOUT"] = 300 #seconds before a running job is taken to be abandoned and run again
+app.config["JOB_FLUSH_WAIT"] = 10 #most seconds flask runjobs --once waits for jobs running in other workers
+app.config["JOB_POLL_INTERVAL"] = 1 #seconds an idle worker waits before checking for new jobs
+app.config["JOB_KEEP_DAYS"] = 7 #finished jobs, and so their idempotency keys, are kept this long
+#compressed copies of static files, made at startup
+app.config["ASSET_CACHE_FOLDER"] = path.join(app.instance_path, "assets")
+app.config["ASSET_MAX_AGE"] = 60 * 60 * 24 * 365 #fingerprinted static urls are cached for a year
+#lets a fronting server such as nginx send static files itself
+app.config["USE_X_SENDFILE"] = environ.get("USE_X_SENDFILE") == "1"
 
 if not path.exists(app.config["UPLOAD_FOLDER"]):
     makedirs(app.config["UPLOAD_FOLDER"])
@@ -23,22 +84,25 @@ except OSError:
     pass
 
 db.init_app(app)
+if app.config["SQLITE_TUNING"]:
+    with app.app_context():
+        tuneconnections(db.engine, app.config["SQLITE_PRAGMAS"])
+        #the journal mode belongs to the file, so read only connections leave it alone
+        tuneconnections(db.engines["replica"], {name: value for name, value in app.config["SQLITE_PRAGMAS"].items() if name != "journal_mode"})
 
 #handles admin user authentication
 class Auth():
     def __init__(self):
         pass   
     
-    #checks that there hasn't been more than 5 logins within the last 10 minutes
+    #checks that there haven't been LOGIN_MAX_ATTEMPTS logins within the login window
     def exceeded_attempts(self, email):
         #retreives admin info
         Admin = dbAdmin.query.filter_by(email=email).first()
         if Admin:
-            event = self.find_login_event(Admin.id)
-            if event:
-                if event.attempts >= 5:
-                    #if reached, then lock account until 10 mins since the first attempt has passed
-                    return True
+            if UserThrottle.attempts(Admin.id, request.remote_addr) >= app.config["LOGIN_MAX_ATTEMPTS"]:
+                #if reached, then lock account until 10 mins since the first attempt has passed
+                return True
         return False
 
     #checks the admin credentials are correct
@@ -50,7 +114,7 @@ class Auth():
             return "Incorrect Credentials"
         
         #if email exists, check password matches
-        if not bcrypt.checkpw(password.encode('utf-8'), Admin.password):
+        if not UserPasswords.checkpw(password, Admin.password):
             #log attempt
             self.record_attempt(Admin.id, "Unsuccesful Login Attempt", "High")
             return "Incorrect Credentials"
@@ -61,42 +125,135 @@ class Auth():
         self.record_attempt(Admin.id, "Succesful Login Attempt", "Critical")
         return "correct"
 
-    #checks how many login events for that account and ip in the last 10 minutes
-    def find_login_event(self, adminid):
-        #retrieves all events for that admin
-        adminloginevents = dbLogin_Event.query.filter_by(admin_id=adminid).all()
-        ip_address=request.remote_addr
-        timestamp=datetime.now()
-
-        if adminloginevents !=[]: #if there are login events for that admin id
-            for event in adminloginevents: #for each event in the list
-                if event.ip_address == ip_address: #if the stored ip matchies the current one
-                    original_time = event.timestamp #start time
-                    new_time = original_time + timedelta(minutes=10) #end time
-                    if (timestamp <= new_time) and (timestamp >= original_time): #if time is in the range
-                        return event
-
-
+    #counts the attempt for this account and ip, the login event is saved in the background
     def record_attempt(self, adminid, message, severity):
-        event = self.find_login_event(adminid) #find corresponding event
-        if event and message == "Unsuccesful Login Attempt": #if unsuccessful
-            event.attempts += 1 #increment attempts
-            db.session.commit()
-        elif event and message == "Succesful Login Attempt": #if successful
-            event.attempts = 0 #reset attempts
-            db.session.commit()
-        else:
-            #record new login attempt
-            loginevent = dbLogin_Event(timestamp=datetime.now(), attempts=1, ip_address=request.remote_addr, action_details=message, severity=severity,  admin_id=adminid)
-            db.session.add(loginevent)
-            db.session.commit()
+        UserThrottle.record(adminid, request.remote_addr, message, severity)
 
 #initalise the objects
-UserCart = Cart()
+if app.config["CART_BACKEND"] == "memory":
+    UserCarts = MemoryCartStore(app.config["CART_MAX"], app.config["CART_TTL"])
+else:
+    UserCarts = DatabaseCartStore(app.config["CART_TTL"])
 UserValidation = Validation()
-UserCurrency = CurrencyConverter()
+UserCurrency = CurrencyConverter(app.config["RATES_FILE"], app.config["RATES_CHECK_INTERVAL"])
 UserAuth = Auth()
-
+UserJobs = JobQueue(app, app.config["JOB_MAX_ATTEMPTS"], app.config["JOB_BACKOFF"], app.config["JOB_TIMEOUT"],
+                    app.config["JOB_POLL_INTERVAL"], app.config["JOB_KEEP_DAYS"], app.config["JOBS_IN_PROCESS"], app.config["JOB_FLUSH_WAIT"])
+UserThrottle = LoginThrottle(app, UserJobs, app.config["LOGIN_WINDOW"], app.config["LOGIN_THROTTLE_SIZE"], app.config["LOGIN_MAX_ATTEMPTS"])
+UserPasswords = PasswordPool(app.config["PASSWORD_WORKERS"], app.config["PASSWORD_QUEUE"], app.config["PASSWORD_TIMEOUT"])
+UserSalesReport = SalesReport()
+UserCatalog = Catalog(app.config["CATALOG_CHECK_INTERVAL"])
+UserOrders = OrderWriter(UserSalesReport, UserCatalog, UserJobs, app.config["LOW_STOCK_LEVEL"])
+UserPages = PageCache(app.config["PAGE_CACHE_SIZE"])
+UserPrices = PriceTable(UserCatalog, UserCurrency)
+UserOrderDetails = OrderDetails()
+UserExporter = Exporter(UserSalesReport, app.config["EXPORT_BATCH_SIZE"])
+UserImporter = ProductImporter(UserCatalog, app.config["IMPORT_CHUNK_SIZE"])
+UserMetrics = Metrics(app.config["QUERY_BUDGET"], app.config["QUERY_REPEAT_LIMIT"])
+if app.config["METRICS_ENABLED"]:
+    with app.app_context():
+        UserMetrics.attach(app, db.engines.values())
+UserAssets = StaticAssets(app, app.config["ASSET_CACHE_FOLDER"], app.config["ASSET_MAX_AGE"])
+UserImages = ImagePipeline(app, UserJobs, UserCatalog, app.config["IMAGE_WIDTHS"], UserAssets)
+#templates pick image sizes with srcset(product.image) and imagevariant(product.image, width)
+app.jinja_env.globals["srcset"] = UserImages.srcset
+app.jinja_env.globals["imagevariant"] = UserImages.variant
+#asset(url) fingerprints a /static url stored as text, url_for("static", ...) does it by itself
+app.jinja_env.globals["asset"] = UserAssets.url
+app.view_functions["static"] = UserAssets.serve
+UserPager = Pager(app.config["ADMIN_PAGE_SIZE"], app.config["ADMIN_COUNT_TTL"])
+
+#columns each admin list can be sorted and searched by
+listcolumns = {
+    dbProduct: ["relevance", "id", "name", "colour", "stock"],
+    dbOrder: ["relevance", "id", "ref_number", "order_date", "shipping_date", "customer_id", "status"],
+}
+
+#gets one page of an admin list from the filter form or the page links
+def adminlist(table, values):
+    sorter = values.get("sorter", "id")
+    if sorter not in listcolumns[table]:
+        sorter = "id"
+    order = "desc" if values.get("order") == "desc" else "asc"
+    searchitem = values.get("searchitem", "")
+    #relevance is the search rank, best matches first when ascending
+    column = None if sorter == "relevance" else getattr(table, sorter)
+    query, column = UserValidation.sorter(column, order, table, searchitem)
+    page = UserPager.page(query, table, column, order, values.get("after", type=int), (table.__tablename__, sorter, searchitem))
+    return page, {"sorter": sorter, "order": order, "searchitem": searchitem}
+
+#fetches a set of products from the catalog cache, returns product id -> product
+def loadproducts(productids):
+    products = {}
+    for productid in productids:
+        product = UserCatalog.getproduct(productid)
+        #products deleted since they were added to the cart are dropped
+        if product:
+            products[productid] = product
+    return products
+
+#loads the visitor's cart from the cart store with the current names and prices
+#also returns the products in the cart so callers don't have to query them again
+def loadcart():
+    cart = Cart()
+    products = {}
+    if "cartid" in session:
+        items = UserCarts.get(session["cartid"])
+        products = loadproducts(list(items))
+        for productid, product in products.items():
+            #a product with a price that can't be charged is left out of the cart
+            if not math.isfinite(product.price):
+                continue
+            cart.addproduct(CartProduct(product.name, items[productid], product.price, productid))
+    return cart, products
+
+#writes the visitor's cart back to the cart store
+def savecart(cart):
+    if "cartid" not in session:
+        session["cartid"] = secrets.token_hex(16)
+    UserCarts.save(session["cartid"], cart.getquantities())
+
+#removes the visitor's cart from the cart store
+def emptycart():
+    if "cartid" in session:
+        UserCarts.delete(session["cartid"])
+
+#serves a storefront page from the page cache, only rendering it the first time
+#the page is keyed by route, currency, catalog version and rates version since nothing else changes it
+def cachedpage(key, render):
+    key = key + (UserCurrency.currency(), UserCatalog.getversion(), UserCurrency.getrates().version)
+    page = UserPages.get(key)
+    if page is None:
+        page = UserPages.put(key, render())
+    response = make_response(page.body)
+    response.set_etag(page.etag)
+    response.last_modified = page.lastmodified
+    #the currency isn't part of the url so browsers must revalidate every time
+    response.cache_control.no_cache = True
+    response.vary.add("Cookie")
+    #answers with 304 if the browser already has this version
+    return response.make_conditional(request)
+
+
+#routes that only read, including the search and tracking forms which are posted
+readonlyroutes = {"home", "product_detail", "faq", "track_order", "view_order", "adminhome", "adminproducts", "productfilter",
+                  "adminaddproduct", "admineditproduct", "adminorders", "orderfilter", "adminvieweditorder", "adminexport"}
+
+#picks the database for this request, a visitor who just changed something keeps reading from the primary
+@app.before_request
+def routedatabase():
+    now = datetime.now().timestamp()
+    if request.method == "POST" and request.endpoint not in readonlyroutes:
+        session["primaryuntil"] = now + app.config["READ_STICKY_SECONDS"]
+    g.readreplica = request.endpoint in readonlyroutes and session.get("primaryuntil", 0) < now
+
+#adds the fingerprint to every url_for("static", ...) so the file can be cached forever
+@app.url_defaults
+def fingerprintstatic(endpoint, values):
+    if endpoint == "static" and "v" not in values:
+        fingerprint = UserAssets.fingerprint(values["filename"])
+        if fingerprint:
+            values["v"] = fingerprint
 
 
 # <-------------------- Customer Routes -------------------->
@@ -124,20 +281,25 @@ def index():
 @app.route("/home")
 def home():
     # Displays all the products in the current currency
-    products = dbProduct.query.all() 
-    rate = UserCurrency.currentrate()
-    symbol = UserCurrency.currentsymbol()
-    currency = UserCurrency.currency()
-    # Render the home page with the products and currency information
-    return render_template("/customer/home.html", products=products, rate=rate, symbol=symbol, currency=currency)
+    def render():
+        products = UserCatalog.getproducts()
+        prices = UserPrices.getprices(UserCurrency.getcurrency())
+        symbol = UserCurrency.currentsymbol()
+        currency = UserCurrency.currency()
+        # Render the home page with the products and currency information
+        return render_template("/customer/home.html", products=products, prices=prices, symbol=symbol, currency=currency)
+    return cachedpage(("home",), render)
 
 # Route for changing the currency
 @app.route("/home/currency", methods=["POST"])
 def changecurrency():
     # If the user wants to change the currency, this function gets triggered
+    # The currency is stored in the user's session so it only changes their prices
     newcurrency = request.form["currency"]
-    if newcurrency in ["USD", "EUR", "JPY", "GBP", "AUD", "CAD", "CHF", "CNY"]:
-        # Set the new currency
+    if newcurrency in UserCurrency.currencies:
+        UserCurrency.setnew(UserCurrency.currencies.index(newcurrency))
+    elif newcurrency in [str(index) for index in range(len(UserCurrency.currencies))]:
+        # the currency dropdowns send the index
         UserCurrency.setnew(newcurrency)
 
     redirectpage = request.form["redirectpage"]
@@ -169,13 +331,15 @@ def product_detail(product_id, added=False):
         added = request.args['added']
     except KeyError:
         pass
-    # Query the database for the product with the given product_id
-    product = db.session.get(dbProduct, product_id)
-    rate = UserCurrency.currentrate()
-    symbol = UserCurrency.currentsymbol()
-    currency = UserCurrency.currency()
-    # Render the product detail page with the product and currency information
-    return render_template("/customer/product.html", product=product, rate=rate, symbol=symbol, currency=currency, added=added)
+    def render():
+        # Get the product with the given product_id from the catalog cache
+        product = UserCatalog.getproduct(product_id)
+        prices = UserPrices.getprices(UserCurrency.getcurrency())
+        symbol = UserCurrency.currentsymbol()
+        currency = UserCurrency.currency()
+        # Render the product detail page with the product and currency information
+        return render_template("/customer/product.html", product=product, prices=prices, symbol=symbol, currency=currency, added=added)
+    return cachedpage(("product", product_id, added), render)
 
 @app.route("/faq")
 def faq():
@@ -196,22 +360,14 @@ def view_order():
         # Get the reference number and email from the form
         refnum = request.form["refnum"]
         email = request.form["email"]
-        # retrieve the order from the database
-        order = dbOrder.query.filter_by(ref_number=refnum).first()
-        order_id = order.id
-
-        #retrieve the customer and order items
-        customer = dbCustomer.query.filter_by(id=order.customer_id).first()
-        orderitems = dbOrder_Item.query.filter_by(order_id=order_id).all()
-        products = []
-        for item in orderitems:
-            products = dbProduct.query.filter_by(id=item.product_id).all()
-
-        #check if the email matches the email of the customer
-        if customer.email != email:
+        # retrieve the order, customer and order items from the database
+        detail = UserOrderDetails.byref(refnum)
+
+        #check the order exists and the email matches the email of the customer
+        if detail is None or detail.customer is None or detail.customer.email != email:
             return render_template("/customer/trackorder.html", error="No results found", refnum=refnum, email=email, currency = UserCurrency.currency())
         else:
-            return render_template("/customer/trackorder.html", order=order, orderitems=orderitems, customer=customer, products=products, currency = UserCurrency.currency())
+            return render_template("/customer/trackorder.html", order=detail.order, lines=detail.lines, customer=detail.customer, currency = UserCurrency.currency())
 
 
 @app.route("/home/product/<int:product_id>/addedtocart", methods=["GET","POST"])
@@ -219,25 +375,23 @@ def addedtocart(product_id):
     if request.method == "POST":
         # Get the product id and quantity from the form
         product = db.session.get(dbProduct, product_id)
+        #a product with a price that can't be charged can't be added
+        if not math.isfinite(product.price):
+            return redirect("/home/product/" + str(product_id))
 
         #code to prevent buffer overflow vulnerability
         availabequantity = product.stock
         try:
             amount = int(request.form["quantity"])
-            if amount > availabequantity:
+            if amount < 1 or amount > availabequantity:
                  return redirect("/home/product/" + str(product_id))
         except ValueError:
             return redirect("/home/product/" + str(product_id))
 
-        exists = False
-
-        # Check if the product is already in the cart
-        for item in UserCart.getproducts():
-            if product.name == item.name:
-                item.increasequantity(amount)
-                exists = True
-        if not exists:
-            UserCart.addproduct(CartProduct(product.name, amount, product.price))
+        # Add the product, or increase its quantity if it is already in the cart
+        cart, _ = loadcart()
+        cart.addproduct(CartProduct(product.name, amount, product.price, product.id))
+        savecart(cart)
         # if the user accessed from home page, direct to cart
         try:
             test = request.form["identifier"]
@@ -249,61 +403,70 @@ def addedtocart(product_id):
 @app.route("/cart")
 def cart():
     # Get the number of products, the total price, the products, and the stock of each product
-    numberproducts = UserCart.gettotalproducts()
-    totalprice = UserCart.gettotalprice()
-    products = UserCart.getproducts()
-    productstock = []
+    cart, cartproducts = loadcart()
+    numberproducts = cart.gettotalproducts()
+    products = cart.getproducts()
+    productstock = {}
     #if the cart is empty, the user cannot checkout
     if numberproducts == 0:
         allowcheckout = False
     else:
         #if the cart is not empty, the user can checkout
-        #get the stock of each product in the cart
-        for product in products:
-            productstock.append(dbProduct.query.filter_by(name = product.name).first())
+        #get the stock of each product in the cart by id
+        for productid, product in cartproducts.items():
+            productstock[productid] = product.stock
         allowcheckout = True 
 
-    rate = UserCurrency.currentrate()
+    #line and cart totals in the current currency from the price table
+    linetotals, totalprice = UserPrices.cartprices(cart, UserCurrency.getcurrency())
     symbol = UserCurrency.currentsymbol()
     currency = UserCurrency.currency()
-    totalprice = totalprice * rate
-    return render_template("/customer/cart.html", numberproducts=numberproducts, totalprice=totalprice, products=products, allowcheckout=allowcheckout, rate=rate, symbol=symbol, currency=currency, productstock=productstock)
+    return render_template("/customer/cart.html", numberproducts=numberproducts, totalprice=totalprice, products=products, allowcheckout=allowcheckout, linetotals=linetotals, symbol=symbol, currency=currency, productstock=productstock)
 
 @app.route("/cart/remove",  methods=["POST"])
 def remove_from_cart():
     # Remove the product from the cart
-    product_name = request.form["product_name"]
-    UserCart.removeproduct(product_name)
+    product_id = int(request.form["product_id"])
+    cart, _ = loadcart()
+    cart.removeproduct(product_id)
+    savecart(cart)
     return redirect("/cart")
 
 @app.route("/cart/update", methods=["POST"])
 def update_cart():
     # Update the quantity of the product in the cart
-    product_name = request.form["product_name"]
-    quantity = int(request.form["quantity"])
-    stock = dbProduct.query.filter_by(name=product_name).first()
-    #check if the quantity is greater than the stock
-    if int(stock.stock) >= (quantity):
+    product_id = int(request.form["product_id"])
+    try:
+        quantity = int(request.form["quantity"])
+    except ValueError:
+        return redirect("/cart")
+    stock = db.session.get(dbProduct, product_id)
+    #check the quantity is at least one and no more than the stock
+    if 1 <= quantity <= int(stock.stock):
         #if it is, update the quantity
-        for product in UserCart.getproducts():
-            if product.name == product_name:
-                product.updatequantity(quantity)
+        cart, _ = loadcart()
+        cart.updatequantity(product_id, quantity)
+        savecart(cart)
     return redirect("/cart")
 
 @app.route("/cart/empty", methods=["POST"])
 def empty_cart():
     # Empty the cart
-    UserCart.emptycart()
+    emptycart()
     return redirect("/cart")
 
 @app.route("/cart/checkout")
 def checkout():
     # direct user to checkout page
-    numberproducts = UserCart.gettotalproducts()
-    totalprice = UserCart.gettotalprice()
-    products = UserCart.getproducts()
+    cart, _ = loadcart()
+    numberproducts = cart.gettotalproducts()
+    #an empty cart has nothing to check out
+    if numberproducts == 0:
+        return redirect("/cart")
+    linetotals, totalprice = UserPrices.cartprices(cart, UserCurrency.getcurrency())
+    products = cart.getproducts()
     symbol = UserCurrency.currentsymbol()
-    return render_template("/customer/checkout.html", numberproducts=numberproducts, totalprice=totalprice, products=products, symbol=symbol, currency = UserCurrency.currency())
+    return render_template("/customer/checkout.html", numberproducts=numberproducts, totalprice=totalprice, products=products, linetotals=linetotals, symbol=symbol, currency = UserCurrency.currency())
 
 
 @app.route("/cart/checkout/complete", methods=["POST","GET"])
@@ -343,43 +506,17 @@ def ordercomplete():
 
 
     #if data is valid, create order
-    order_details = UserCart.getproducts() 
-    totalprice = UserCart.gettotalprice()
-    order_date = datetime.now()
-    shipping_date = datetime.now() + timedelta(days=7)
-   
-    #check if customer exists
-    customer = dbCustomer.query.filter_by(email=Form[2][1]).first()
-    if not customer:
-        #create new customer if they don"t exist
-        customer = dbCustomer(forename=Form[0][1], surname=Form[1][1], email=Form[2][1], street=Form[3][1], city=Form[4][1], postcode=Form[5][1])
-        db.session.add(customer)
-        db.session.commit()
-
-    #creates reference number
-    isnew = False
-    while isnew == False:
-        refnum = "SC-"
-        for i in range(16):
-            refnum += str(randint(0, 9))
-            if not dbOrder.query.filter_by(ref_number=refnum).first(): #checks there isn"t already an order with that refnum
-                isnew=True
-    
-    #create new order
-    neworder = dbOrder(ref_number=refnum, total_price=totalprice, order_date=order_date, shipping_date=shipping_date, status="paid", customer_id=customer.id)
-    db.session.add(neworder)
-    db.session.commit()
+    cart, _ = loadcart()
+    customerdetails = {"forename": Form[0][1], "surname": Form[1][1], "email": Form[2][1], "street": Form[3][1], "city": Form[4][1], "postcode": Form[5][1]}
 
-    #add order items to order
-    for item in order_details:
-        product = dbProduct.query.filter_by(name=item.name).first()
-        product.stock -= item.quantity
-        neworderitem = dbOrder_Item(order_id=neworder.id, product_id=product.id, quantity=item.quantity, price=item.total)
-        db.session.add(neworderitem)
-    db.session.commit()
+    #customer, order, items and stock are written in one transaction with a new reference number
+    try:
+        refnum = UserOrders.placeorder(customerdetails, cart).ref_number
+    except (OutOfStock, EmptyCart) as error:
+        return render_template("/customer/checkout.html", errors=[str(error)], currency = UserCurrency.currency())
 
     #empty cart
-    UserCart.emptycart()
+    emptycart()
     return render_template("/customer/ordercomplete.html",refnum = refnum, currency = UserCurrency.currency())
 
 
@@ -396,27 +533,15 @@ def adminhome():
         return redirect("/admin/login")
     
     #get all the data needed for the admin home page
-    lowstock = dbProduct.query.filter(dbProduct.stock <= 10).all()
+    lowstock = dbProduct.query.filter(dbProduct.stock <= app.config["LOW_STOCK_LEVEL"]).all()
     admins = dbAdmin.query.all()
 
     today = datetime.now()
     weekago = today - timedelta(days=7)
     recentloginattempts = dbLogin_Event.query.filter(dbLogin_Event.timestamp >= weekago)
 
-    salesreport = []
-    for order in dbOrder.query.all(): #for order in all existing order
-        orderitems = dbOrder_Item.query.filter_by(order_id = order.id).all() #get all orderitems for that order
-        for item in orderitems: #for each item that was retrieved
-            found = False
-            product = dbProduct.query.filter_by(id=item.product_id).first() #get the product name
-            if salesreport !=[]: #if sales report is empty
-                for sale in salesreport: #for each item in sales report
-                    if sale.name == product.name: #if it is the same product
-                        sale.increasequantity(item.quantity) #increase the quantity
-                        found = True #set found to true and break the loop
-                        break
-            if found == False:
-                salesreport.append(CartProduct(product.name, item.quantity, product.price))
+    #per product totals come from the summary table maintained at checkout
+    salesreport = UserSalesReport.getreport()
 
     return render_template("/admin/index.html", lowstock=lowstock, admins=admins, salesreport=salesreport, recentloginattempts=recentloginattempts)
 
@@ -431,11 +556,14 @@ def adminlogin():
         #if the user has exceeded the login attempts
         if UserAuth.exceeded_attempts(email):
             message = "Login Attempts Exceeded"
-        #if the user has entered the wrong credentials
-        elif UserAuth.check_credentials(email, password) != "correct":
-            message = UserAuth.check_credentials(email, password)
         else:
-            return redirect("/admin")
+            #credentials are only checked once as bcrypt is slow on purpose
+            try:
+                message = UserAuth.check_credentials(email, password)
+            except PasswordsBusy as error:
+                return render_template("/admin/login.html", message=str(error)), 503
+            if message == "correct":
+                return redirect("/admin")
         return render_template("/admin/login.html", message=message)
             
     return render_template("/admin/login.html")
@@ -475,7 +603,10 @@ def createadmin():
         return render_template("/admin/index.html", message=errors)
     
     #if there are no errors, hash the password and create a new admin account
-    hashed = bcrypt.hashpw(password.encode('utf-8'),bcrypt.gensalt())
+    try:
+        hashed = UserPasswords.hashpw(password)
+    except PasswordsBusy as error:
+        return render_template("/admin/index.html", message=str(error)), 503
     newadmin = dbAdmin(forename=forename, email=email, password=hashed)
     db.session.add(newadmin)
     db.session.commit()
@@ -487,9 +618,8 @@ def adminproducts():
     #if the user isn't logged in, redirect to login page
     if "email" not in session:
         return redirect("/admin/login")
-    products = dbProduct.query.all()
-    
-    return render_template("/admin/products.html", products=products, index = 0)
+    page, filters = adminlist(dbProduct, request.args)
+    return render_template("/admin/products.html", products=page.items, page=page, filters=filters, index = 0)
     
 @app.route("/admin/products/filter", methods=["POST"])
 def productfilter():
@@ -497,14 +627,9 @@ def productfilter():
     if "email" not in session:
         return redirect("/admin/login")
     
-    #get the data from the form
-    sorter = request.form.get("sorter")
-    order = request.form.get("order")
-    searchitem = request.form.get("searchitem")
-    #sort the products
-    column = getattr(dbProduct, sorter) 
-    products = UserValidation.sorter(column, order, dbProduct, searchitem)
-    return render_template("/admin/products.html", products=products)
+    #sort the products using the form data
+    page, filters = adminlist(dbProduct, request.form)
+    return render_template("/admin/products.html", products=page.items, page=page, filters=filters)
     
 
 @app.route("/admin/products/add")
@@ -535,18 +660,25 @@ def adminupdateproduct():
         product_id = request.form["product_id"]
         name = request.form["name"]
         description = request.form["description"]
+        colour = request.form["colour"]
+        price = request.form["price"]
+        stock = request.form["stock"]
 
-        #check if an image has been uploaded
+        #the price and stock are checked before anything is saved, a bad price would break every page
+        UserValidation.reseterrors()
+        UserValidation.isprice("price", price)
+        UserValidation.iscount("stock", stock)
+        errors = UserValidation.geterrors()
+        if errors:
+            product = db.session.get(dbProduct, int(product_id)) if product_id.isdigit() else None
+            return render_template("/admin/newedit.html", product=product, product_id=product.id if product else None, errors=errors)
+
+        #check if an image has been uploaded, it is saved under a hash of its content
         image = request.files["image"]
         filename = secure_filename(image.filename)
         if filename != "":
-            image_path = path.join(app.config["UPLOAD_FOLDER"], filename)
-            image.save(image_path)
-            img = "/static/uploads/" + filename
-
-        colour = request.form["colour"]
-        price = request.form["price"]
-        stock = request.form["stock"]
+            img = UserImages.save(image)
+        oldimage = None
 
         #check if the product already exists
         try:
@@ -556,9 +688,7 @@ def adminupdateproduct():
             product.description = description
             #if an image has been uploaded, update the image
             if filename != "":
-                to_remove = product.image.replace("/static/uploads/","")
-                image_path = path.join(app.config["UPLOAD_FOLDER"], to_remove)
-                remove(image_path)
+                oldimage = product.image
                 product.image = img
             product.colour = colour
             product.price = price
@@ -569,8 +699,30 @@ def adminupdateproduct():
             product = dbProduct(name=name, description=description, image=img, colour=colour, price=price, stock=stock)
             db.session.add(product)
         db.session.commit()
+        #the replaced image is only deleted once nothing uses it
+        if oldimage and oldimage != product.image:
+            UserImages.discard(oldimage)
         return redirect("/admin/products")
 
+@app.route("/admin/products/import", methods=["GET","POST"])
+def adminimportproducts():
+    #if the user isn't logged in, redirect to login page
+    if "email" not in session:
+        return redirect("/admin/login")
+    if request.method == "GET":
+        return render_template("/admin/import.html")
+
+    #the feed type comes from the file extension, .csv or .jsonl
+    feed = request.files.get("feed")
+    fmt = path.splitext(feed.filename)[1].lower().lstrip(".") if feed else ""
+    if fmt not in ["csv", "jsonl"]:
+        return render_template("/admin/import.html", message="Upload a .csv or .jsonl file")
+    #the upload is read a row at a time rather than loaded whole
+    #a decoding reader rather than TextIOWrapper, as python 3.10's SpooledTemporaryFile has no readable()
+    stream = codecs.getreader("utf-8-sig")(feed.stream)
+    report = UserImporter.load(stream, fmt)
+    return render_template("/admin/import.html", report=report)
+
 @app.route("/admin/products/delete", methods=["GET","POST"])
 def admindeleteproduct():
     #if the user isn't logged in, redirect to login page
@@ -581,9 +733,11 @@ def admindeleteproduct():
     product_id = request.form["product_id"]
     #delete the product
     product = db.session.get(dbProduct, product_id)
-    remove(product.image)
+    image = product.image
     db.session.delete(product)
     db.session.commit()
+    #removes the image and its variants unless another product shares it
+    UserImages.discard(image)
     return redirect("/admin/products")
 
 @app.route("/admin/orders")
@@ -591,8 +745,36 @@ def adminorders():
     #if the user isn't logged in, redirect to login page
     if "email" not in session:
         return redirect("/admin/login")
-    orders = dbOrder.query.all()
-    return render_template("/admin/orders.html", orders=orders, index = 0)
+    page, filters = adminlist(dbOrder, request.args)
+    return render_template("/admin/orders.html", orders=page.items, page=page, filters=filters, index = 0)
+
+@app.route("/admin/metrics")
+def adminmetrics():
+    #if the user isn't logged in and didn't send the metrics token, redirect to login page
+    token = app.config["METRICS_TOKEN"]
+    if "email" not in session and not (token and secrets.compare_digest(request.headers.get("Authorization", ""), "Bearer " + token)):
+        return redirect("/admin/login")
+    return Response(UserMetrics.export(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/admin/export/<report>.<fmt>")
+def adminexport(report, fmt):
+    #if the user isn't logged in, redirect to login page
+    if "email" not in session:
+        return redirect("/admin/login")
+    if report not in UserExporter.reports or fmt not in UserExporter.formats:
+        return redirect("/admin")
+
+    #optional date range from and to, both inclusive
+    try:
+        start = datetime.strptime(request.args["from"], "%Y-%m-%d") if request.args.get("from") else None
+        end = datetime.strptime(request.args["to"], "%Y-%m-%d") + timedelta(days=1) if request.args.get("to") else None
+    except ValueError:
+        return "Dates must be in the format YYYY-MM-DD", 400
+
+    #rows are sent as they are read rather than built into one big response
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return Response(stream_with_context(UserExporter.stream(report, fmt, start, end)), mimetype=mimetype,
+                    headers={"Content-Disposition": "attachment; filename=" + report + "." + fmt})
 
 @app.route("/admin/orders/<int:order_id>")
 def adminvieweditorder(order_id):
@@ -601,29 +783,20 @@ def adminvieweditorder(order_id):
         return redirect("/admin/login")
     
     #get the order, customer and order items
-    order = dbOrder.Session.get(order_id)
-    order_id = order.id
-    customer = dbCustomer.query.filter_by(id=order.customer_id).first()
-    orderitems = dbOrder_Item.query.filter_by(order_id=order_id).all()
-    products = []
-    for item in orderitems:
-        products = dbProduct.query.filter_by(id=item.product_id).all()
+    detail = UserOrderDetails.byid(order_id)
+    if detail is None:
+        return redirect("/admin/orders")
 
-    return render_template("/admin/order.html", order=order, orderitems=orderitems, customer=customer, products=products)
+    return render_template("/admin/order.html", order=detail.order, lines=detail.lines, customer=detail.customer)
 
 @app.route("/admin/orders/filter", methods=["POST"])
 def orderfilter():
     #if the user isn't logged in, redirect to login page
     if "email" not in session:
         return redirect("/admin/login")
-    #get the data from the form
-    sorter = request.form.get("sorter")
-    order = request.form.get("order")
-    searchitem = request.form.get("searchitem")
-    #sort the orders
-    column = getattr(dbOrder, sorter) 
-    orders = UserValidation.sorter(column, order, dbOrder, searchitem)
-    return render_template("/admin/orders.html", orders = orders)
+    #sort the orders using the form data
+    page, filters = adminlist(dbOrder, request.form)
+    return render_template("/admin/orders.html", orders=page.items, page=page, filters=filters)
     
 @app.route("/admin/orders/<int:order_id>/update", methods=["GET","POST"])
 def adminupdateorder(order_id):
@@ -670,7 +843,50 @@ def adminupdatestatus(order_id):
 
 
 
-if __name__ == "__main__":
+#wsgi servers only import the app, so this is where a deployed database gets its migrations
+if app.config["MIGRATE_ON_START"]:
     with app.app_context():
-        db.create_all()
-    app.run(debug=False)
\ No newline at end of file
+        migrate()
+
+#brings an existing database up to date, run with: flask --app main migrate
+@app.cli.command("migrate")
+def migratecommand():
+    migrate()
+    print("Database schema is up to date")
+
+@app.cli.command("importproducts")
+@click.argument("filename", type=click.Path(exists=True, dir_okay=False))
+def importproductscommand(filename):
+    #flask --app main importproducts products.csv
+    fmt = "csv" if filename.lower().endswith(".csv") else "jsonl"
+    def progress(report):
+        print("{} rows read, {} added, {} updated, {} failed".format(report.read, report.inserted, report.updated, report.failed))
+    with open(filename, encoding="utf-8-sig", newline="") as stream:
+        report = UserImporter.load(stream, fmt, progress)
+    for line, message in report.errors:
+        print("line {}: {}".format(line, message))
+    print("Import finished")
+
+@app.cli.command("runjobs")
+@click.option("--once", is_flag=True, help="run the jobs that are due then exit")
+def runjobscommand(once):
+    #flask --app main runjobs, start as many as needed alongside web workers running with JOBS_IN_PROCESS=0
+    if once:
+        UserJobs.flush()
+        print("No jobs left to run")
+    else:
+        UserJobs.work()
+
+@app.cli.command("imagevariants")
+def imagevariantscommand():
+    #makes the smaller copies for product images uploaded before they existed
+    for (image,) in db.session.query(dbProduct.image).distinct():
+        if UserImages.filepath(image) and path.exists(UserImages.filepath(image)):
+            UserImages.queue(image)
+    db.session.commit()
+    UserImages.flush()
+    print("Image variants are up to date")
+
+
+if __name__ == "__main__":
+    app.run(debug=False)
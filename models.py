@@ -1,18 +1,50 @@
+from flask import g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import DDL, event, func, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql.dml import UpdateBase
+from datetime import datetime
+
+#sends reads to the "replica" bind while a read only route sets g.readreplica, everything else uses the primary
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and "replica" in self._db.engines and not self.info.get("wrote"):
+            if self._flushing or isinstance(clause, UpdateBase):
+                #once this session has written, its reads go to the primary too so it sees its own changes
+                self.info["wrote"] = True
+            elif has_request_context() and g.get("readreplica"):
+                return self._db.engines["replica"]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
 
 #initialise database
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+#a read only connection to the same file for sqlite urls, other databases are returned unchanged
+def readonlyurl(url):
+    if not url.startswith("sqlite:///") or url == "sqlite:///:memory:":
+        return url
+    return "sqlite:///file:" + url[len("sqlite:///"):] + "?mode=ro&uri=true"
+
+#runs the pragmas on every new sqlite connection, they are per connection apart from journal_mode
+def tuneconnections(engine, pragmas):
+    def connect(dbapiconnection, record):
+        cursor = dbapiconnection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA " + name + " = " + str(value))
+        cursor.close()
+    event.listen(engine, "connect", connect)
 
 #define product table
 class dbProduct(db.Model):
     #id, name, description, image, colour, price stock
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(255), nullable=False)
+    name = db.Column(db.String(255), nullable=False, index=True)
     description = db.Column(db.Text, nullable=False)
     image = db.Column(db.Text, nullable=False)
-    colour = db.Column(db.String(255), nullable=False)
+    colour = db.Column(db.String(255), nullable=False, index=True)
     price = db.Column(db.Float, nullable=False)
-    stock = db.Column(db.Integer)
+    stock = db.Column(db.Integer, index=True)
 
 #define customer table
 class dbCustomer(db.Model):
@@ -29,21 +61,21 @@ class dbCustomer(db.Model):
 class dbOrder(db.Model):
     #id, ref_number, total_price, order_date, shipping_date, status, customer_id
     id = db.Column(db.Integer, primary_key=True)
-    ref_number = db.Column(db.String(255), nullable=False)
+    ref_number = db.Column(db.String(255), nullable=False, unique=True, index=True)
     total_price = db.Column(db.Float, nullable=False)
-    order_date = db.Column(db.DateTime, nullable=False)
-    shipping_date = db.Column(db.DateTime, nullable=False)
-    status = db.Column(db.String(255), nullable=False)
-    customer_id = db.Column(db.Integer, db.ForeignKey(dbCustomer.id))
+    order_date = db.Column(db.DateTime, nullable=False, index=True)
+    shipping_date = db.Column(db.DateTime, nullable=False, index=True)
+    status = db.Column(db.String(255), nullable=False, index=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey(dbCustomer.id), index=True)
     customer_rel = db.relationship('dbCustomer', backref='customer')
 
 #define order_item table
 class dbOrder_Item(db.Model):
     #id, order_id, product_id, quantity, price
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey(dbOrder.id))
+    order_id = db.Column(db.Integer, db.ForeignKey(dbOrder.id), index=True)
     order_rel = db.relationship('dbOrder', backref='orderitems')
-    product_id = db.Column(db.Integer, db.ForeignKey(dbProduct.id))
+    product_id = db.Column(db.Integer, db.ForeignKey(dbProduct.id), index=True)
     product_rel = db.relationship('dbProduct', backref='productitems')
     quantity = db.Column(db.Integer, nullable=False)
     price = db.Column(db.Float, nullable=False)
@@ -60,10 +92,151 @@ class dbAdmin(db.Model):
 class dbLogin_Event(db.Model):
     #id, timestamp, attempts, ip_address, action_details, severity, admin_id
     id = db.Column(db.Integer, primary_key=True)
-    timestamp = db.Column(db.DateTime, nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False, index=True)
     attempts = db.Column(db.Integer, nullable=False)
     ip_address = db.Column(db.String(255), nullable=False)
     action_details = db.Column(db.String(255), nullable=False)
     severity = db.Column(db.String(255), nullable=False)
     admin_id = db.Column(db.Integer, db.ForeignKey(dbAdmin.id))
-    admin_rel = db.relationship('dbAdmin', backref='logins')
\ No newline at end of file
+    admin_rel = db.relationship('dbAdmin', backref='logins')
+    #login throttling looks events up by admin and ip within a time window, each window is one row
+    __table_args__ = (db.Index('ix_db_login__event_admin_ip_time', 'admin_id', 'ip_address', 'timestamp', unique=True),)
+
+#define sales_summary table
+class dbSales_Summary(db.Model):
+    #product_id, quantity, revenue - running totals kept up to date at checkout
+    product_id = db.Column(db.Integer, db.ForeignKey(dbProduct.id), primary_key=True)
+    product_rel = db.relationship('dbProduct', backref='salessummary')
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+
+
+#define cart table, one row per visitor session
+class dbCart(db.Model):
+    #cart_id, items, updated - items is the json encoded product id -> quantity map
+    cart_id = db.Column(db.String(64), primary_key=True)
+    items = db.Column(db.Text, nullable=False)
+    updated = db.Column(db.DateTime, nullable=False, index=True)
+
+#define catalog_version table, a single row every worker checks to know when products changed
+class dbCatalog_Version(db.Model):
+    #id, version
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+#define schema_version table, one row per migration that has been applied
+class dbSchema_Version(db.Model):
+    #version, description, applied
+    version = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.String(255), nullable=False)
+    applied = db.Column(db.DateTime, nullable=False)
+
+#define job table, deferred work run by the job queue's workers
+class dbJob(db.Model):
+    #id, kind, payload, key, status, attempts, run_after, locked_at, error, finished
+    #key is an optional idempotency key, a job with the same key is only queued once
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(64), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    key = db.Column(db.String(255), unique=True)
+    status = db.Column(db.String(16), nullable=False, default="queued")
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_after = db.Column(db.DateTime, nullable=False)
+    locked_at = db.Column(db.DateTime)
+    error = db.Column(db.Text)
+    finished = db.Column(db.DateTime)
+    #workers claim the oldest due job
+    __table_args__ = (db.Index('ix_db_job_status_run_after', 'status', 'run_after'),)
+
+#trigram full text indexes for the admin search, kept in step with their tables by triggers
+#only edits to searched columns touch the index, so stock changes at checkout don't
+productsearch = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS product_search USING fts5(name, description, colour, content='db_product', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS product_search_insert AFTER INSERT ON db_product BEGIN "
+    "INSERT INTO product_search(rowid, name, description, colour) VALUES (new.id, new.name, new.description, new.colour); END",
+    "CREATE TRIGGER IF NOT EXISTS product_search_delete AFTER DELETE ON db_product BEGIN "
+    "INSERT INTO product_search(product_search, rowid, name, description, colour) VALUES ('delete', old.id, old.name, old.description, old.colour); END",
+    "CREATE TRIGGER IF NOT EXISTS product_search_update AFTER UPDATE OF name, description, colour ON db_product BEGIN "
+    "INSERT INTO product_search(product_search, rowid, name, description, colour) VALUES ('delete', old.id, old.name, old.description, old.colour); "
+    "INSERT INTO product_search(rowid, name, description, colour) VALUES (new.id, new.name, new.description, new.colour); END",
+    "INSERT INTO product_search(product_search) VALUES ('rebuild')",
+]
+#orders are searched by reference number, status and the customer's name and email
+ordersearch = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS order_search USING fts5(ref_number, status, customer, tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS order_search_insert AFTER INSERT ON db_order BEGIN "
+    "INSERT INTO order_search(rowid, ref_number, status, customer) VALUES (new.id, new.ref_number, new.status, "
+    "(SELECT forename || ' ' || surname || ' ' || email FROM db_customer WHERE id = new.customer_id)); END",
+    "CREATE TRIGGER IF NOT EXISTS order_search_delete AFTER DELETE ON db_order BEGIN "
+    "DELETE FROM order_search WHERE rowid = old.id; END",
+    "CREATE TRIGGER IF NOT EXISTS order_search_update AFTER UPDATE OF ref_number, status, customer_id ON db_order BEGIN "
+    "UPDATE order_search SET ref_number = new.ref_number, status = new.status, "
+    "customer = (SELECT forename || ' ' || surname || ' ' || email FROM db_customer WHERE id = new.customer_id) WHERE rowid = new.id; END",
+    "CREATE TRIGGER IF NOT EXISTS order_search_customer AFTER UPDATE OF forename, surname, email ON db_customer BEGIN "
+    "UPDATE order_search SET customer = new.forename || ' ' || new.surname || ' ' || new.email "
+    "WHERE rowid IN (SELECT id FROM db_order WHERE customer_id = new.id); END",
+    "DELETE FROM order_search",
+    "INSERT INTO order_search(rowid, ref_number, status, customer) SELECT db_order.id, ref_number, status, "
+    "forename || ' ' || surname || ' ' || email FROM db_order LEFT JOIN db_customer ON db_customer.id = db_order.customer_id",
+]
+
+#new databases get the search tables with their tables, drop_all removes them again
+for statement in productsearch:
+    event.listen(dbProduct.__table__, "after_create", DDL(statement))
+for statement in ordersearch:
+    event.listen(dbOrder.__table__, "after_create", DDL(statement))
+event.listen(dbProduct.__table__, "before_drop", DDL("DROP TABLE IF EXISTS product_search"))
+event.listen(dbOrder.__table__, "before_drop", DDL("DROP TABLE IF EXISTS order_search"))
+
+#schema changes for databases created by older versions of the app
+#each migration is (version, description, sql statements) and must be safe to rerun
+migrations = [
+    (1, "index hot lookup columns", [
+        "CREATE INDEX IF NOT EXISTS ix_db_product_name ON db_product (name)",
+        "CREATE INDEX IF NOT EXISTS ix_db_product_stock ON db_product (stock)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_db_order_ref_number ON db_order (ref_number)",
+        "CREATE INDEX IF NOT EXISTS ix_db_order_customer_id ON db_order (customer_id)",
+        "CREATE INDEX IF NOT EXISTS ix_db_order__item_order_id ON db_order__item (order_id)",
+        "CREATE INDEX IF NOT EXISTS ix_db_order__item_product_id ON db_order__item (product_id)",
+        "CREATE INDEX IF NOT EXISTS ix_db_login__event_timestamp ON db_login__event (timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_db_login__event_admin_ip_time ON db_login__event (admin_id, ip_address, timestamp)",
+    ]),
+    #the admin lists page through rows in the order of any sortable column
+    (2, "index admin list sort columns", [
+        "CREATE INDEX IF NOT EXISTS ix_db_product_colour ON db_product (colour)",
+        "CREATE INDEX IF NOT EXISTS ix_db_order_order_date ON db_order (order_date)",
+        "CREATE INDEX IF NOT EXISTS ix_db_order_shipping_date ON db_order (shipping_date)",
+        "CREATE INDEX IF NOT EXISTS ix_db_order_status ON db_order (status)",
+    ]),
+    (3, "full text search for the admin lists", productsearch + ordersearch),
+    #fills the sales summary from orders placed before it existed, an empty table means it was never filled
+    (4, "backfill the sales summary", [
+        "INSERT INTO db_sales__summary (product_id, quantity, revenue) "
+        "SELECT db_order__item.product_id, SUM(db_order__item.quantity), SUM(db_order__item.price) FROM db_order__item "
+        "JOIN db_product ON db_product.id = db_order__item.product_id "
+        "WHERE NOT EXISTS (SELECT 1 FROM db_sales__summary) GROUP BY db_order__item.product_id",
+    ]),
+    #login event jobs upsert one row per window, duplicates left by the old writer keep their newest row
+    (5, "one login event per admin, ip and window", [
+        "DELETE FROM db_login__event WHERE id NOT IN "
+        "(SELECT MAX(id) FROM db_login__event GROUP BY admin_id, ip_address, timestamp)",
+        "DROP INDEX IF EXISTS ix_db_login__event_admin_ip_time",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_db_login__event_admin_ip_time ON db_login__event (admin_id, ip_address, timestamp)",
+    ]),
+]
+
+#creates any missing tables then applies migrations newer than the stored version
+def migrate():
+    db.create_all()
+    current = db.session.query(func.max(dbSchema_Version.version)).scalar() or 0
+    for version, description, statements in migrations:
+        if version > current:
+            for statement in statements:
+                db.session.execute(text(statement))
+            db.session.add(dbSchema_Version(version=version, description=description, applied=datetime.now()))
+            #each migration is committed on its own so a failure leaves earlier ones in place
+            try:
+                db.session.commit()
+            except IntegrityError:
+                #another worker starting at the same time recorded it first, the statements are safe to rerun
+                db.session.rollback()
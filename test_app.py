@@ -1,9 +1,14 @@
 import pytest
-from flask import Flask
+from flask import Flask, g, template_rendered, url_for
 from datetime import datetime, timedelta
 import os
+import io
 import bcrypt
-from main import app, db 
+import threading
+from sqlalchemy import event
+# jobs only run when a test flushes them, not on a background thread as well
+os.environ["JOBS_IN_PROCESS"] = "0"
+from main import app, db, readonlyroutes, UserSalesReport, UserOrders, UserCatalog, UserPrices, UserThrottle, UserImages, UserMetrics, UserJobs, UserAssets
 from models import *
 from library import * 
 
@@ -68,6 +73,36 @@ def create_order(customer_id):
     db.session.commit()
     return order
 
+# adds a product to the client's cart
+def add_to_cart(client, product, quantity):
+    client.post(f"/home/product/{product.id}/addedtocart", data={"quantity": quantity})
+
+# posts a valid checkout form for whatever is in the cart
+def complete_order(client):
+    return client.post("/cart/checkout/complete", data={
+        "forename": "test",
+        "surname": "test",
+        "email": "test@gmail.com",
+        "street": "25 test road",
+        "city": "test town",
+        "postcode": "cv4 7al",
+        "cardnumber": "1234567890",
+        "expirydate": "2099-04",
+        "cvv": "123"
+    }, follow_redirects=True)
+
+# counts the sql statements run while the client makes a request
+def count_queries(client, method, url, **kwargs):
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        getattr(client, method)(url, **kwargs)
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+    return len(statements)
+
 # admin login helper function
 def admin_login(client, email, password):
     client.post("/admin/login", data={"email": email, "S3curePword!": password}, follow_redirects=True)
@@ -126,6 +161,36 @@ def test_admin_update_product(test_client):
     }, follow_redirects=True)
     assert response.status_code == 200
 
+# tests a stored price that can't be converted doesn't break the shop, and the form won't save one
+def test_invalid_product_price(test_client):
+    good = create_product(name="Good Slime", price=2.5, stock=3)
+    bad = create_product(name="Bad Slime", price=float("inf"), stock=3)
+    response = test_client.get("/home")
+    assert response.status_code == 200
+    assert b"Good Slime" in response.data
+    test_client.post(f"/home/product/{bad.id}/addedtocart", data={"quantity": "1"})
+    test_client.post(f"/home/product/{good.id}/addedtocart", data={"quantity": "1"})
+    response = test_client.get("/cart")
+    assert response.status_code == 200
+    assert b"Good Slime" in response.data and b"Bad Slime" not in response.data
+
+    with test_client.session_transaction() as session:
+        session["email"] = "admin@gmail.com"
+    for price, stock in [("inf", "3"), ("nan", "3"), ("1e400", "3"), ("-1", "3"), ("2.5", "-1"), ("2.5", "lots")]:
+        response = test_client.post("/admin/products/update", data={
+            "product_id": good.id,
+            "name": "Good Slime",
+            "description": "still good",
+            "price": price,
+            "stock": stock,
+            "colour": "Red",
+        })
+        assert response.status_code == 200
+        assert b"Invalid" in response.data
+    db.session.expire_all()
+    assert db.session.get(dbProduct, good.id).price == 2.5
+    assert db.session.get(dbProduct, good.id).stock == 3
+
 # tests if admin can delete products
 def test_admin_delete_product(test_client):
     create_admin(email="admin@gmail.com", password="S3curePword!")
@@ -217,8 +282,6 @@ def test_faq(test_client):
 # tests if customer can add product to cart
 def test_add_to_cart(test_client):
     product = create_product(name="Test Slime", price=12.99, stock=8)
-    with test_client.session_transaction() as client_session:
-        client_session["cart"] = {"products": []}
     response = test_client.post(f"/home/product/{product.id}/addedtocart", data={"quantity": 2}, follow_redirects=True)
     assert response.status_code == 200
     assert b"Test Slime" in response.data
@@ -227,8 +290,6 @@ def test_add_to_cart(test_client):
 # tests if customer can view cart
 def test_cart(test_client):
     product = create_product(name="Test Slime", price=12.99, stock=8)
-    with test_client.session_transaction() as client_session:
-        client_session["cart"] = {"products": []}
     test_client.post(f"/home/product/{product.id}/addedtocart", data={"quantity": 2}, follow_redirects=True)
     response = test_client.get("/cart")
     assert response.status_code == 200
@@ -237,34 +298,30 @@ def test_cart(test_client):
 
 # tests if customer can remove product from cart
 def test_remove_from_cart(test_client):
-    create_product(name="Test Slime", price=12.99, stock=8)
-    with test_client.session_transaction() as client_session:
-        client_session["cart"] = {"products": [{"name": "Test Slime", "quantity": 2, "price": 12.99, "total": 25.98}]}
-    response = test_client.post("/cart/remove", data={"product_name": "Test Slime"}, follow_redirects=True)
+    product = create_product(name="Test Slime", price=12.99, stock=8)
+    add_to_cart(test_client, product, 2)
+    response = test_client.post("/cart/remove", data={"product_id": product.id}, follow_redirects=True)
     assert response.status_code == 200
 
 # tests if customer can update product quantity in cart
 def test_update_cart(test_client):
-    create_product(name="Test Slime", price=12.99, stock=8)
-    with test_client.session_transaction() as client_session:
-        client_session["cart"] = {"products": [{"name": "Test Slime", "quantity": 2, "price": 12.99, "total": 25.98}]}
-    response = test_client.post("/cart/update", data={"product_name": "Test Slime", "quantity": 3}, follow_redirects=True)
+    product = create_product(name="Test Slime", price=12.99, stock=8)
+    add_to_cart(test_client, product, 2)
+    response = test_client.post("/cart/update", data={"product_id": product.id, "quantity": 3}, follow_redirects=True)
     assert response.status_code == 200
     assert b"3" in response.data
 
 # tests if customer can empty cart
 def test_empty_cart(test_client):
-    create_product(name="Test Slime", price=12.99, stock=8)
-    with test_client.session_transaction() as client_session:
-        client_session["cart"] = {"products": [{"name": "Test Slime", "quantity": 2, "price": 12.99, "total": 25.98}]}
+    product = create_product(name="Test Slime", price=12.99, stock=8)
+    add_to_cart(test_client, product, 2)
     response = test_client.post("/cart/empty", follow_redirects=True)
     assert response.status_code == 200
 
 # tests if customer can checkout
 def test_checkout(test_client):
-    create_product(name="Test Slime", price=12.99, stock=8)
-    with test_client.session_transaction() as client_session:
-        client_session["cart"] = {"products": [{"name": "Test Slime", "quantity": 2, "price": 12.99, "total": 25.98}]}
+    product = create_product(name="Test Slime", price=12.99, stock=8)
+    add_to_cart(test_client, product, 2)
     response = test_client.get("/cart/checkout")
     assert response.status_code == 200
     assert b"Checkout" in response.data
@@ -272,9 +329,8 @@ def test_checkout(test_client):
 # tests that order can be completed
 def test_order_complete(test_client):
     #tests with valid data
-    create_product(name="Test Slime", price=12.99, stock=8)
-    with test_client.session_transaction() as client_session:
-        client_session["cart"] = {"products": [{"name": "Test Slime", "quantity": 2, "price": 12.99, "total": 25.98}]}
+    product = create_product(name="Test Slime", price=12.99, stock=8)
+    add_to_cart(test_client, product, 2)
     response = test_client.post("/cart/checkout/complete", data={
         "forename": "test",
         "surname": "test",
@@ -320,3 +376,632 @@ def test_view_order(test_client):
     response = test_client.post("/trackorder/view", data={"refnum": order.ref_number, "email": "invalid@gmail.com"})
     assert response.status_code == 200
     assert b"No results found" in response.data
+
+# tests that checkout keeps the sales summary in line with the order history
+def test_sales_report_summary(test_client):
+    product = create_product(name="Sales Slime", price=5.0, stock=8)
+    add_to_cart(test_client, product, 3)
+    complete_order(test_client)
+    UserJobs.flush()
+    report = UserSalesReport.getreport()
+    assert [(sale.name, sale.quantity, sale.total) for sale in report] == [("Sales Slime", 3, 15.0)]
+    # rebuilding from the order items gives the same totals
+    UserSalesReport.rebuild()
+    report = UserSalesReport.getreport()
+    assert [(sale.name, sale.quantity, sale.total) for sale in report] == [("Sales Slime", 3, 15.0)]
+
+# tests that migrating an older database adds the indexes and sales summary without losing rows
+def test_migrate_adds_indexes(test_app):
+    db.session.execute(text("DROP INDEX ix_db_order_ref_number"))
+    db.session.commit()
+    customer = create_customer(email="migrate@gmail.com")
+    order = create_order(customer_id=customer.id)
+    product = create_product(name="Old Slime", price=4.0, stock=8)
+    db.session.add(dbOrder_Item(order_id=order.id, product_id=product.id, quantity=2, price=8.0))
+    db.session.commit()
+    assert UserSalesReport.getreport() == []
+    migrate()
+    assert [(sale.name, sale.quantity, sale.total) for sale in UserSalesReport.getreport()] == [("Old Slime", 2, 8.0)]
+    indexes = [row[0] for row in db.session.execute(text("SELECT name FROM sqlite_master WHERE type='index'"))]
+    assert "ix_db_order_ref_number" in indexes
+    assert "ix_db_login__event_admin_ip_time" in indexes
+    assert dbOrder.query.count() == 1
+    assert db.session.get(dbSchema_Version, 1) is not None
+
+# tests that each visitor gets their own cart
+def test_carts_are_per_session(test_app):
+    product = create_product(name="Test Slime", price=12.99, stock=8)
+    first = test_app.test_client()
+    second = test_app.test_client()
+    add_to_cart(first, product, 2)
+    assert b"Test Slime" in first.get("/cart").data
+    assert b"Your cart is empty" in second.get("/cart").data
+
+# tests that the memory cart store drops the least recently used and expired carts
+def test_memory_cart_store_eviction():
+    store = MemoryCartStore(maxcarts=2, ttl=60)
+    store.save("a", {1: 2})
+    store.save("b", {2: 1})
+    store.get("a")
+    store.save("c", {3: 1})
+    assert store.get("b") == {}
+    assert store.get("a") == {1: 2}
+    store.carts["a"].touched -= 120
+    assert store.get("a") == {}
+    assert store.get("c") == {3: 1}
+
+# tests that the cart keeps its totals up to date as lines change
+def test_cart_running_totals():
+    cart = Cart()
+    cart.addproduct(CartProduct("Red Slime", 2, 1.10, 1))
+    cart.addproduct(CartProduct("Blue Slime", 1, 2.25, 2))
+    cart.addproduct(CartProduct("Red Slime", 1, 1.10, 1))
+    assert cart.gettotalproducts() == 2
+    assert cart.gettotalquantity() == 4
+    assert cart.gettotalprice() == 5.55
+    cart.updatequantity(2, 3)
+    assert cart.gettotalprice() == 10.05
+    cart.removeproduct(1)
+    assert cart.gettotalquantity() == 3
+    assert cart.gettotalprice() == 6.75
+    assert cart.getquantities() == {2: 3}
+
+# tests that cart and checkout pages don't run a query per cart line
+def test_cart_queries_constant(test_client):
+    add_to_cart(test_client, create_product(name="Slime 0", price=1.0, stock=5), 1)
+    test_client.get("/cart")
+    cartqueries = count_queries(test_client, "get", "/cart")
+    checkoutqueries = count_queries(test_client, "get", "/cart/checkout")
+    for i in range(1, 6):
+        add_to_cart(test_client, create_product(name="Slime " + str(i), price=1.0, stock=5), 1)
+    test_client.get("/cart")
+    assert count_queries(test_client, "get", "/cart") == cartqueries
+    assert count_queries(test_client, "get", "/cart/checkout") == checkoutqueries
+
+# tests that a checkout with too little stock writes nothing
+def test_order_out_of_stock(test_client):
+    product = create_product(name="Test Slime", price=12.99, stock=8)
+    add_to_cart(test_client, product, 5)
+    product.stock = 2
+    db.session.commit()
+    response = complete_order(test_client)
+    assert b"enough stock" in response.data
+    assert dbOrder.query.count() == 0
+    assert dbCustomer.query.count() == 0
+    assert db.session.get(dbProduct, product.id).stock == 2
+
+# tests that quantities below one never reach an order and an empty cart can't be checked out
+def test_order_bad_quantities(test_client):
+    product = create_product(name="Test Slime", price=12.99, stock=8)
+    for quantity in ["-5", "0", "lots"]:
+        add_to_cart(test_client, product, quantity)
+    assert b"Your cart is empty" in complete_order(test_client).data
+    assert test_client.get("/cart/checkout").status_code == 302
+    add_to_cart(test_client, product, 2)
+    for quantity in ["-5", "0", "lots"]:
+        test_client.post("/cart/update", data={"product_id": product.id, "quantity": quantity})
+    # the order writer turns a quantity below one away even if it gets into a cart
+    cart = Cart()
+    cart.addproduct(CartProduct("Test Slime", -5, 12.99, product.id))
+    details = {"forename": "test", "surname": "test", "email": "test@gmail.com", "street": "25 test road", "city": "test town", "postcode": "cv4 7al"}
+    with pytest.raises(OutOfStock):
+        UserOrders.placeorder(details, cart)
+    with pytest.raises(EmptyCart):
+        UserOrders.placeorder(details, Cart())
+    assert dbOrder.query.count() == 0
+    assert db.session.get(dbProduct, product.id).stock == 8
+    complete_order(test_client)
+    assert dbOrder_Item.query.one().quantity == 2
+    assert db.session.get(dbProduct, product.id).stock == 6
+
+# tests that concurrent checkouts of a low stock product never oversell
+def test_concurrent_checkout_no_oversell(test_app):
+    productid = create_product(name="Last Slime", price=5.0, stock=3).id
+    placed = []
+    def checkout(number):
+        with app.app_context():
+            cart = Cart()
+            cart.addproduct(CartProduct("Last Slime", 1, 5.0, productid))
+            details = {"forename": "test", "surname": "test", "email": "buyer" + str(number) + "@gmail.com",
+                       "street": "25 test road", "city": "test town", "postcode": "cv4 7al"}
+            try:
+                UserOrders.placeorder(details, cart)
+                placed.append(number)
+            except OutOfStock:
+                pass
+    threads = [threading.Thread(target=checkout, args=(number,)) for number in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    db.session.expire_all()
+    assert len(placed) == 3
+    assert dbOrder.query.count() == 3
+    assert db.session.get(dbProduct, productid).stock == 0
+
+# tests that reference numbers keep the old format and carry a valid check digit
+def test_reference_numbers():
+    refnumbers = RefNumbers()
+    refnum = refnumbers.generate()
+    assert len(refnum) == 19 and refnum.startswith("SC-") and refnum[3:].isdigit()
+    assert refnumbers.checkdigit(refnum[3:18]) == int(refnum[18])
+
+# tests that a clashing reference number is retried once with a new one
+def test_reference_number_retry(test_client):
+    customer = create_customer(email="test@gmail.com")
+    create_order(customer_id=customer.id)
+    product = create_product(name="Test Slime", price=12.99, stock=8)
+    cart = Cart()
+    cart.addproduct(CartProduct("Test Slime", 1, 12.99, product.id))
+    generated = iter(["SC-1234567890123456", "SC-0000000000000000"])
+    UserOrders.refnumbers.generate = lambda: next(generated)
+    try:
+        order = UserOrders.placeorder({"forename": "test", "surname": "test", "email": "test@gmail.com",
+                                       "street": "25 test road", "city": "test town", "postcode": "cv4 7al"}, cart)
+    finally:
+        del UserOrders.refnumbers.generate
+    assert order.ref_number == "SC-0000000000000000"
+    assert dbOrder.query.count() == 2
+    assert db.session.get(dbProduct, product.id).stock == 7
+
+# tests that storefront pages are served from the catalog cache once it is warm
+def test_catalog_cache(test_client):
+    product = create_product(name="Test Slime", price=12.99, stock=8)
+    test_client.get("/home")
+    assert count_queries(test_client, "get", "/home") == 0
+    assert count_queries(test_client, "get", f"/home/product/{product.id}") == 0
+    # an admin edit through the orm invalidates the cache straight away
+    product.name = "Renamed Slime"
+    db.session.commit()
+    assert b"Renamed Slime" in test_client.get("/home").data
+    # so does a change made by another worker, seen through the shared version
+    db.session.execute(text("UPDATE db_product SET name = 'Other Slime'"))
+    db.session.execute(text("UPDATE db_catalog__version SET version = version + 1"))
+    db.session.commit()
+    UserCatalog.checked = 0
+    assert b"Other Slime" in test_client.get("/home").data
+
+# tests that storefront pages are rendered once and revalidated with their etag
+def test_page_cache(test_client):
+    product = create_product(name="Test Slime", price=12.99, stock=8)
+    rendered = []
+    def record(sender, template, context, **extra):
+        rendered.append(template.name)
+    template_rendered.connect(record, app)
+    try:
+        first = test_client.get("/home")
+        second = test_client.get("/home")
+        assert rendered == ["/customer/home.html"]
+        assert second.data == first.data
+        etag = first.headers["ETag"]
+        assert test_client.get("/home", headers={"If-None-Match": etag}).status_code == 304
+        # changing a product moves the catalog version on so the page is rendered again
+        product.price = 15.0
+        db.session.commit()
+        response = test_client.get("/home", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        assert len(rendered) == 2
+    finally:
+        template_rendered.disconnect(record, app)
+
+# tests that prices are converted once into whole minor units of every currency
+def test_price_table(test_app):
+    product = create_product(name="Test Slime", price=12.99, stock=8)
+    assert UserPrices.getprices(3)[product.id] == "12.99"
+    assert UserPrices.getprices(0)[product.id] == "15.98"
+    assert UserPrices.getprices(2)[product.id] == "2192"
+    cart = Cart()
+    cart.addproduct(CartProduct(product.name, 3, product.price, product.id))
+    assert UserPrices.cartprices(cart, 0) == ({product.id: "47.94"}, "47.94")
+
+# tests that cart totals are kept in pence and don't pick up float drift
+def test_cart_totals_exact():
+    cart = Cart()
+    cart.addproduct(CartProduct("Cheap Slime", 1, 0.1, 1))
+    cart.addproduct(CartProduct("Cheaper Slime", 1, 0.2, 2))
+    assert cart.gettotalprice() == 0.3
+    for i in range(100):
+        cart.updatequantity(1, i + 1)
+    cart.removeproduct(1)
+    assert cart.gettotalprice() == 0.2
+
+# tests that changing currency only affects the visitor who changed it
+def test_currency_per_session(test_app):
+    product = create_product(name="Test Slime", price=12.99, stock=8)
+    first = test_app.test_client()
+    second = test_app.test_client()
+    first.post("/home/currency", data={"currency": "0", "redirectpage": "/home"})
+    assert b"$15.98" in first.get("/home").data
+    assert b"\xc2\xa312.99" in second.get("/home").data
+    assert b"15.98" in first.get(f"/home/product/{product.id}").data
+    assert b"12.99" in second.get(f"/home/product/{product.id}").data
+
+# tests that a new rates file is picked up without a restart
+def test_rates_reload(tmp_path):
+    ratesfile = tmp_path / "rates.json"
+    ratesfile.write_text('{"USD": "1.50"}')
+    converter = CurrencyConverter(str(ratesfile), checkinterval=0)
+    before = converter.getrates()
+    assert before.rates[0] == Decimal("1.50")
+    assert before.rates[1] == Decimal("1.15")
+    ratesfile.write_text('{"USD": "2"}')
+    os.utime(ratesfile, ns=(0, 10 ** 9))
+    after = converter.getrates()
+    assert after.rates[0] == Decimal("2")
+    assert after.version == before.version + 1
+    # the old snapshot is untouched for anyone still using it
+    assert before.rates[0] == Decimal("1.50")
+    # a broken file keeps the current rates
+    ratesfile.write_text('{"USD": "not a rate"}')
+    os.utime(ratesfile, ns=(0, 2 * 10 ** 9))
+    assert converter.getrates() is after
+
+# tests that failed logins are counted per admin and ip and saved
+def test_login_throttle(test_app):
+    admin = create_admin(email="admin@gmail.com", password="S3curePword!")
+    throttle = LoginThrottle(test_app, UserJobs, 600, 100, 5)
+    for i in range(5):
+        throttle.record(admin.id, "10.0.0.1", "Unsuccesful Login Attempt", "High")
+    assert throttle.attempts(admin.id, "10.0.0.1") == 5
+    assert throttle.attempts(admin.id, "10.0.0.2") == 0
+    throttle.flush()
+    assert dbLogin_Event.query.filter_by(ip_address="10.0.0.1").one().attempts == 5
+    # jobs from several workers add to the one row for a window whatever order they commit in
+    payload = {"adminid": admin.id, "ip": "10.0.0.9", "start": datetime(2024, 1, 1).isoformat(), "message": "Unsuccesful Login Attempt", "severity": "High"}
+    for change in ["add", "add", "add"]:
+        throttle.writeevent(dict(payload, change=change))
+    db.session.commit()
+    assert dbLogin_Event.query.filter_by(ip_address="10.0.0.9").one().attempts == 3
+    throttle.writeevent(dict(payload, change="reset"))
+    db.session.commit()
+    assert dbLogin_Event.query.filter_by(ip_address="10.0.0.9").one().attempts == 0
+    # another worker picks the window up from the database
+    assert LoginThrottle(test_app, UserJobs, 600, 100, 5).attempts(admin.id, "10.0.0.1") == 5
+    # only the newest windows are kept in memory
+    small = LoginThrottle(test_app, UserJobs, 600, 2, 5)
+    for ip in ["10.0.1.1", "10.0.1.2", "10.0.1.3"]:
+        small.record(admin.id, ip, "Unsuccesful Login Attempt", "High")
+    assert list(small.windows) == [(admin.id, "10.0.1.2"), (admin.id, "10.0.1.3")]
+    small.flush()
+    # attempts made through another worker count towards the limit
+    first = LoginThrottle(test_app, UserJobs, 600, 100, 5)
+    second = LoginThrottle(test_app, UserJobs, 600, 100, 5)
+    for i in range(3):
+        first.record(admin.id, "10.0.2.1", "Unsuccesful Login Attempt", "High")
+    first.flush()
+    for i in range(2):
+        second.record(admin.id, "10.0.2.1", "Unsuccesful Login Attempt", "High")
+    second.flush()
+    assert first.attempts(admin.id, "10.0.2.1") == 5
+
+# tests that a failed login checks the password once and a correct one logs in
+def test_admin_login_single_check(test_client):
+    UserThrottle.windows.clear()
+    admin = create_admin(email="admin@gmail.com", password="S3curePword!")
+    response = test_client.post("/admin/login", data={"email": "admin@gmail.com", "password": "wrong"})
+    assert b"Incorrect Credentials" in response.data
+    assert UserThrottle.attempts(admin.id, "127.0.0.1") == 1
+    response = test_client.post("/admin/login", data={"email": "admin@gmail.com", "password": "S3curePword!"})
+    assert response.status_code == 302
+    assert test_client.get("/admin").status_code == 200
+    UserThrottle.flush()
+    UserThrottle.windows.clear()
+
+# tests that a good login clears the saved failures, not just the ones counted in memory
+def test_admin_login_resets_attempts(test_client):
+    UserThrottle.windows.clear()
+    admin = create_admin(email="admin@gmail.com", password="S3curePword!")
+    for i in range(4):
+        test_client.post("/admin/login", data={"email": "admin@gmail.com", "password": "wrong"})
+    UserThrottle.flush()
+    response = test_client.post("/admin/login", data={"email": "admin@gmail.com", "password": "S3curePword!"})
+    assert response.status_code == 302
+    # no jobs are run between the good login and the typo
+    response = test_client.post("/admin/login", data={"email": "admin@gmail.com", "password": "wrong"})
+    assert b"Incorrect Credentials" in response.data
+    assert UserThrottle.attempts(admin.id, "127.0.0.1") == 1
+    response = test_client.post("/admin/login", data={"email": "admin@gmail.com", "password": "S3curePword!"})
+    assert response.status_code == 302
+    UserThrottle.flush()
+    assert dbLogin_Event.query.filter_by(admin_id=admin.id).one().attempts == 0
+    UserThrottle.windows.clear()
+
+# tests that password work is turned away once the pool is full
+def test_password_pool_busy():
+    pool = PasswordPool(1, 1, 5)
+    release = threading.Event()
+    worker = threading.Thread(target=pool.run, args=(release.wait,))
+    worker.start()
+    while pool.pending == 0:
+        release.wait(0.01)
+    with pytest.raises(PasswordsBusy):
+        pool.checkpw("password", bcrypt.hashpw(b"password", bcrypt.gensalt()))
+    release.set()
+    worker.join()
+    assert pool.checkpw("password", bcrypt.hashpw(b"password", bcrypt.gensalt()))
+
+# tests that admin lists are paged by seeking past the last row shown
+def test_admin_list_pages(test_client):
+    # stock can be left empty, those products still get their place in the order
+    for i in range(7):
+        create_product(name="Slime " + str(i), price=1.0, stock=i % 3 or None)
+    pager = Pager(2, 30)
+    for order in ["asc", "desc"]:
+        query, column = Validation().sorter(dbProduct.stock, order, dbProduct, "")
+        seen = []
+        after = None
+        while True:
+            page = pager.page(query, dbProduct, column, order, after, "test")
+            assert page.total == 7 and not page.restarted
+            seen += [(product.stock or 0, product.id) for product in page.items]
+            after = page.after
+            if after is None:
+                break
+        assert seen == sorted(seen, reverse=order == "desc")
+        assert len(set(seen)) == 7
+    # a page following a deleted row says it has gone back to the start
+    query, column = Validation().sorter(dbProduct.stock, "asc", dbProduct, "")
+    after = pager.page(query, dbProduct, column, "asc", None, "test").after
+    db.session.delete(db.session.get(dbProduct, after))
+    db.session.commit()
+    page = pager.page(query, dbProduct, column, "asc", after, "test")
+    assert page.restarted and page.items[0].stock is None
+    with test_client.session_transaction() as session:
+        session["email"] = "admin@gmail.com"
+    response = test_client.get("/admin/products?sorter=name&order=asc&searchitem=Slime")
+    assert b"Showing 6 of 6" in response.data
+    create_order(create_customer("customer@gmail.com").id)
+    response = test_client.post("/admin/orders/filter", data={"sorter": "order_date", "order": "desc", "searchitem": ""})
+    assert b"SC-1234567890123456" in response.data
+
+# tests that admin search uses the full text index and follows product and order changes
+def test_admin_search(test_app):
+    search = Validation()
+    def names(table, searchitem):
+        query, column = search.sorter(None, "asc", table, searchitem)
+        return [row.id for row in query.all()]
+    ocean = create_product(name="Ocean Slime", price=1.0, stock=5)
+    forest = create_product(name="Forest Slime", price=1.0, stock=5)
+    glitter = create_product(name="Ocean Ocean Glitter", price=1.0, stock=5)
+    assert names(dbProduct, "ocean") == [glitter.id, ocean.id]
+    assert sorted(names(dbProduct, "Oc")) == [ocean.id, glitter.id]
+    assert names(dbProduct, 'a"b') == []
+    forest.name = "Deep Ocean"
+    db.session.delete(glitter)
+    db.session.commit()
+    assert sorted(names(dbProduct, "ocean")) == [ocean.id, forest.id]
+    order = create_order(create_customer("shopper@gmail.com").id)
+    assert names(dbOrder, "shopper") == [order.id]
+    order.status = "shipped"
+    db.session.commit()
+    assert names(dbOrder, "shipped") == [order.id]
+    assert names(dbOrder, "paid") == []
+
+# tests that the order pages load every item and product with a fixed number of queries
+def test_order_detail_queries(test_client):
+    counts = []
+    for items in [1, 6]:
+        customer = create_customer(email="detail" + str(items) + "@gmail.com")
+        order = dbOrder(ref_number="SC-" + str(items).zfill(16), order_date=datetime.now(), shipping_date=datetime.now(), status="paid", customer_id=customer.id, total_price=10.0)
+        db.session.add(order)
+        for i in range(items):
+            product = create_product(name="Detail Slime " + str(items) + str(i), price=2.0, stock=5)
+            db.session.add(dbOrder_Item(order_rel=order, product_id=product.id, quantity=1, price=2.0))
+        db.session.commit()
+        data = {"refnum": order.ref_number, "email": customer.email}
+        counts.append(count_queries(test_client, "post", "/trackorder/view", data=data))
+    assert counts[0] == counts[1]
+    response = test_client.post("/trackorder/view", data=data)
+    assert response.data.count(b"Detail Slime 6") == 6
+    with test_client.session_transaction() as session:
+        session["email"] = "admin@gmail.com"
+    assert count_queries(test_client, "get", f"/admin/orders/{order.id}") == 1
+    assert test_client.get(f"/admin/orders/{order.id}").data.count(b"Detail Slime 6") == 6
+
+# tests that orders, items and sales stream out as csv and json lines with date filters
+def test_admin_export(test_client):
+    product = create_product(name="Export Slime", price=5.0, stock=20)
+    customer = create_customer(email="export@gmail.com")
+    for day in [1, 2, 3]:
+        order = dbOrder(ref_number="SC-" + str(day).zfill(16), order_date=datetime(2024, 5, day, 12), shipping_date=datetime(2024, 5, day + 7), status="paid", customer_id=customer.id, total_price=5.0 * day)
+        db.session.add(order)
+        db.session.add(dbOrder_Item(order_rel=order, product_id=product.id, quantity=day, price=5.0 * day))
+    db.session.commit()
+    UserSalesReport.rebuild()
+    with test_client.session_transaction() as session:
+        session["email"] = "admin@gmail.com"
+    response = test_client.get("/admin/export/orders.csv?from=2024-05-02&to=2024-05-03")
+    assert response.is_streamed
+    lines = response.get_data(as_text=True).splitlines()
+    assert lines[0] == "id,ref_number,total_price,order_date,shipping_date,status,customer_id,email"
+    assert [line.split(",")[1] for line in lines[1:]] == ["SC-0000000000000002", "SC-0000000000000003"]
+    response = test_client.get("/admin/export/orderitems.jsonl?to=2024-05-01")
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert rows == [{"id": 1, "order_id": 1, "ref_number": "SC-0000000000000001", "order_date": "2024-05-01 12:00:00",
+                     "product_id": product.id, "name": "Export Slime", "quantity": 1, "price": 5.0}]
+    assert test_client.get("/admin/export/sales.csv").get_data(as_text=True).splitlines()[1] == f"{product.id},Export Slime,6,30.0"
+    assert test_client.get("/admin/export/sales.csv?from=2024-05-03").get_data(as_text=True).splitlines()[1] == f"{product.id},Export Slime,3,15.0"
+    assert test_client.get("/admin/export/orders.csv?from=yesterday").status_code == 400
+
+# tests that product feeds are imported in chunks, updating products with the same name
+def test_product_import(test_client):
+    create_product(name="Old Slime", price=1.0, stock=1)
+    UserCatalog.getproducts()
+    feed = ("name,description,image,colour,price,stock\n"
+            "Old Slime,now cheaper,,Red,0.5,9\n"
+            "New Slime,fresh,/static/uploads/new.webp,Blue,3.25,4\n"
+            "Bad Slime,oops,/static/uploads/bad.webp,Blue,free,4\n"
+            "No Image Slime,oops,,Blue,1,4\n")
+    with test_client.session_transaction() as session:
+        session["email"] = "admin@gmail.com"
+    response = test_client.post("/admin/products/import", data={"feed": (io.BytesIO(feed.encode()), "feed.csv")}, content_type="multipart/form-data")
+    assert b"4 rows read, 1 added, 1 updated, 2 failed" in response.data
+    assert b"Invalid price" in response.data
+    assert b"Missing image" in response.data
+    products = {product.name: product for product in UserCatalog.getproducts()}
+    assert products["Old Slime"].price == 0.5
+    assert products["Old Slime"].image == "test_uploads/amber.webp"
+    assert products["New Slime"].stock == 4
+    importer = ProductImporter(UserCatalog, 2)
+    progress = []
+    lines = "".join(json.dumps({"name": "Feed Slime " + str(i), "image": "/static/uploads/x.webp", "colour": "Green", "price": 1, "stock": i}) + "\n" for i in range(5))
+    report = importer.load(io.StringIO(lines + "not json\n"), "jsonl", lambda report: progress.append(report.inserted))
+    assert progress == [2, 4, 5]
+    assert report.errors == [(6, "Invalid json")]
+    assert dbProduct.query.count() == 7
+    # prices that can't be turned into pence and negative stock are turned away, so the storefront keeps working
+    feed = ("name,description,image,colour,price,stock\n"
+            "Inf Slime,x,/static/uploads/x.webp,Red,inf,1\n"
+            "Nan Slime,x,/static/uploads/x.webp,Red,nan,1\n"
+            "Huge Slime,x,/static/uploads/x.webp,Red,1e400,1\n"
+            "Minus Slime,x,/static/uploads/x.webp,Red,1,-5\n")
+    response = test_client.post("/admin/products/import", data={"feed": (io.BytesIO(feed.encode()), "feed.csv")}, content_type="multipart/form-data")
+    assert b"4 rows read, 0 added, 0 updated, 4 failed" in response.data
+    assert b"Invalid stock" in response.data
+    assert test_client.get("/home").status_code == 200
+
+# tests that uploads are stored by content hash with variants that are removed with the last product using them
+def test_image_pipeline(test_client):
+    with open(os.path.join(UPLOAD_FOLDER, "amber.webp"), "rb") as file:
+        data = file.read()
+    with test_client.session_transaction() as session:
+        session["email"] = "admin@gmail.com"
+    for name in ["First Slime", "Second Slime"]:
+        test_client.post("/admin/products/update", data={"product_id": "", "name": name, "description": "test", "price": 1.0, "stock": 5,
+                                                         "colour": "Amber", "image": (io.BytesIO(data), "Amber Photo.webp")}, content_type="multipart/form-data")
+    first, second = dbProduct.query.order_by(dbProduct.id).all()
+    assert first.image == second.image
+    assert first.image.startswith("/static/uploads/") and "amber" not in first.image.lower()
+    UserImages.flush()
+    files = [UserImages.filepath(first.image)] + [UserImages.filepath(UserImages.varianturl(first.image, width)) for width in app.config["IMAGE_WIDTHS"]]
+    assert all(os.path.exists(file) for file in files)
+    assert app.config["IMAGE_WIDTHS"][0] == 160
+    with Image.open(files[1]) as variant:
+        assert variant.width == 160
+    assert UserImages.varianturl(first.image, 160) + " 160w" in test_client.get("/home").get_data(as_text=True)
+    test_client.post("/admin/products/delete", data={"product_id": first.id})
+    assert all(os.path.exists(file) for file in files)
+    UserAssets.manifest[first.image[len("/static/"):]] = Asset("0" * 16, files[0], 0, None, None)
+    test_client.post("/admin/products/delete", data={"product_id": second.id})
+    assert not any(os.path.exists(file) for file in files)
+    assert first.image[len("/static/"):] not in UserAssets.manifest
+
+# tests that static files are linked with a fingerprint and served compressed with long lived caching
+def test_static_assets(test_client):
+    page = test_client.get("/faq").get_data(as_text=True)
+    url = re.search(r'href="(/static/customerstyle/basestyle\.css\?v=[0-9a-f]+)"', page).group(1)
+    with open(os.path.join(app.static_folder, "customerstyle", "basestyle.css"), "rb") as file:
+        css = file.read()
+    response = test_client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "immutable" in response.headers["Cache-Control"]
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert gzip.decompress(response.data) == css
+    response.close()
+    response = test_client.get(url, headers={"Accept-Encoding": "gzip, br"})
+    assert brotli.decompress(response.data) == css
+    response.close()
+    response = test_client.get("/static/customerstyle/basestyle.css?v=old")
+    assert response.data == css
+    assert "immutable" not in response.headers.get("Cache-Control", "")
+    response.close()
+    # a file deleted after it was fingerprinted is a 404
+    removed = os.path.join(app.static_folder, "removed-test.txt")
+    with open(removed, "w") as file:
+        file.write("soon gone")
+    url = UserAssets.url("/static/removed-test.txt")
+    assert "?v=" in url
+    os.remove(removed)
+    assert test_client.get(url).status_code == 404
+
+# tests that read only routes use the replica engine until the visitor posts a change
+def test_read_replica_routing(test_client):
+    customer = create_customer(email="replica@gmail.com")
+    create_order(customer.id)
+    replica = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        replica.append(statement)
+    with test_client.session_transaction() as session:
+        session["email"] = "admin@gmail.com"
+    event.listen(db.engines["replica"], "before_cursor_execute", record)
+    try:
+        db.session.remove()
+        assert b"SC-1234567890123456" in test_client.get("/admin/orders").data
+        assert replica
+        replica.clear()
+        db.session.remove()
+        test_client.post("/home/currency", data={"currency": "0", "redirectpage": "/home"})
+        assert b"SC-1234567890123456" in test_client.get("/admin/orders").data
+        assert replica == []
+    finally:
+        event.remove(db.engines["replica"], "before_cursor_execute", record)
+
+# tests that every read only route name is a real endpoint and only those endpoints read from the replica
+def test_read_only_endpoints(test_app):
+    assert readonlyroutes <= set(app.view_functions)
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint == "static":
+            continue
+        with app.test_request_context():
+            url = url_for(rule.endpoint, **{argument: 1 for argument in rule.arguments})
+        with app.test_request_context(url, method="GET" if "GET" in rule.methods else "POST"):
+            app.preprocess_request()
+            assert g.readreplica == (rule.endpoint in readonlyroutes), rule.endpoint
+
+# tests that requests get a server timing header, show up in the metrics text and repeated statements are flagged
+def test_request_metrics(test_client, caplog):
+    response = test_client.get("/home")
+    assert 'db;dur=' in response.headers["Server-Timing"]
+    assert "tpl;dur=" in response.headers["Server-Timing"]
+    assert test_client.get("/admin/metrics").status_code == 302
+    with test_client.session_transaction() as session:
+        session["email"] = "admin@gmail.com"
+    response = test_client.get("/admin/metrics")
+    assert response.mimetype == "text/plain"
+    assert 'slimeshop_request_seconds_count{endpoint="home"}' in response.get_data(as_text=True)
+    metrics = RequestMetrics(0)
+    metrics.queries = 12
+    metrics.statements = {"SELECT * FROM product WHERE id = ?": 11, "SELECT * FROM orders": 1}
+    UserMetrics.record("nplusone", 0.2, metrics, 0)
+    assert "SELECT * FROM product WHERE id = ?" in caplog.text
+    assert 'slimeshop_query_budget_exceeded_total{endpoint="nplusone"} 1' in UserMetrics.export()
+
+# tests that jobs commit with their transaction, are queued once per key and are retried until they fail
+def test_job_queue(test_client, caplog):
+    product = create_product(name="Queued Slime", price=5.0, stock=12)
+    add_to_cart(test_client, product, 3)
+    complete_order(test_client)
+    UserJobs.flush()
+    assert dbSales_Summary.query.filter_by(product_id=product.id).one().quantity == 3
+    assert [job.kind for job in dbJob.query.filter_by(status="done").order_by(dbJob.id)] == ["sales", "lowstock"]
+    assert "Low stock: Queued Slime is down to 9" in caplog.text
+    # a product already below the level isn't warned about again
+    add_to_cart(test_client, product, 1)
+    complete_order(test_client)
+    assert dbJob.query.filter_by(kind="lowstock").count() == 1
+    calls = []
+    def handler(payload):
+        calls.append(payload["n"])
+        raise ValueError("broken")
+    jobs = JobQueue(app, 2, 0, 300, 1, 7, False, 0.2)
+    jobs.register("broken", handler)
+    jobs.enqueue("broken", {"n": 1}, key="broken:1")
+    jobs.enqueue("broken", {"n": 2}, key="broken:1")
+    db.session.commit()
+    jobs.flush()
+    assert calls == [1, 1]
+    job = dbJob.query.filter_by(key="broken:1").one()
+    assert (job.status, job.attempts, job.error) == ("failed", 2, "ValueError: broken")
+    # committing wakes the queue that added the job
+    jobs.wake.clear()
+    jobs.enqueue("broken", {"n": 3}, key="broken:3", delay=60)
+    db.session.commit()
+    assert jobs.wake.is_set()
+    # a job left running by a worker that died is only waited on for flushwait seconds
+    db.session.add(dbJob(kind="broken", payload="{}", status="running", attempts=1, run_after=datetime.now(), locked_at=datetime.now()))
+    db.session.commit()
+    started = datetime.now()
+    jobs.flush()
+    assert datetime.now() - started < timedelta(seconds=2)
+    assert calls == [1, 1]